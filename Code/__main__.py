@@ -8,52 +8,40 @@ create links and a training set for speech clustering. Grouping speeches
 according to the trained model, it runs a regression to look at variables
 correlated to the likelihood that a member of parliament put higher emphasis on
 WWII, exhibited through the topic of his or her speeches.
+
+Each stage can also be run on its own (`download`, `link`, `sample`, `cluster`,
+`regress`); `enqueue` and `work` share the download among several processes,
+`nlp-service` keeps the spaCy pipeline loaded for the others. The task modules
+pull in heavy libraries (scikit-learn, statsmodels, pandas), which is why they
+are only imported by the stage that needs them.
 """
 
+import argparse
 import logging
-from functools import partial
-from concurrent.futures import ThreadPoolExecutor
-from typing import Callable
-from collections.abc import Iterable
+from datetime import date
 
 
 import sqlalchemy as sql
 import sqlalchemy.orm as orm
 
 
-from download.get_speech import SpeechTask
-from download.get_personal import PersonalTask
-from download.get_election import ElectionTask
-from download.get_session import SessionTask
-from processing.link_speech import SpeechLinkTask
-from processing.sample import SampleTask
-from analysis.speech_clustering import ClusteringTask
-from analysis.regression_analysis import RegressionTask
-
+import models  # registers all tables with `Base`
+import shards
+import stages
 from config import config
-from helpers import Base, logged
+from helpers import Base, logged, setup_logging, work_parallel
 
 
 # Setup -----------------------------------------------------------------------
 
-logging.basicConfig(
-    filename=config['FILES']['LOG'] + "download_files_async.log",
-    encoding="utf-8",
-    level=logging.INFO,
-    filemode="w",
-    format="%(levelname)s %(asctime)s %(name)s %(message)s",
-)
+setup_logging(config['FILES']['LOG'] + "download_files_async.log")
 
 sql_logger = logging.getLogger("sqlalchemy")
 sql_logger.setLevel(logging.WARNING)
 # we have a lot of database transactions which each triggers several logging
 # messages; for debugging purposes it is sensible to choose `INFO` instead
 
-PreparationTasks = [PersonalTask, ElectionTask, SpeechTask,
-                    SessionTask, SampleTask, SpeechLinkTask,  ClusteringTask]
-
-DownloadTasks = [PersonalTask, ElectionTask, SpeechTask]
-# Download differ in two respects: they can be run simultaneously (using
+# Download tasks differ in two respects: they can be run simultaneously (using
 # `work_parallel`) and they download data from the web, whereas later Tasks use
 # data from the built database (and therefore need a database session)
 
@@ -67,32 +55,263 @@ def setup_db(base_class: orm.DeclarativeBase) -> orm.Session:
     session_factory = orm.sessionmaker(bind=engine)
     Session = orm.scoped_session(session_factory)
     base_class.metadata.create_all(engine)
+    if shards.enabled():
+        shards.create_shards()
+        # connections are opened anew, with the shards attached
+        engine.dispose()
+        sql.event.listen(engine, 'connect', shards.attach_shards)
     return Session
 
 
-@ logged
-def work_parallel(worker: Callable, session: orm.Session, items: Iterable) -> None:
-    """work_parallel() creates up to n threads which fetch the profiles and
-    handle the obtained data"""
-    with ThreadPoolExecutor(max_workers=config['MAX_CONCUR_REQ']) as pool:
-        worker = partial(worker, session=session)
-        pool.map(worker, items)
+def apply_subset(args: argparse.Namespace) -> None:
+    """Switch to the subset mode if requested by the config or the command
+    line (whose values take precedence): a separate database and output files
+    and a restricted download"""
+    settings = config['SUBSET']
+    for key, value in [('START', args.subset_start), ('END', args.subset_end),
+                       ('FRACTION', args.subset_fraction)]:
+        if value is not None:
+            settings[key] = value
+            settings['ENABLED'] = True
+    settings['ENABLED'] |= args.subset
+    if settings['ENABLED']:
+        config['DATABASE_URI'] = settings['DATABASE_URI']
+        config['FILES'] |= settings['FILES']
+        logging.info('Subset mode: %s to %s, fraction %s', settings['START'],
+                     settings['END'], settings['FRACTION'])
 
 
-def main():
-    Session = setup_db(Base)
-    for Task in PreparationTasks:
-        if Task in DownloadTasks:
-            items = Task.setup()
-            work_parallel(Task.run, Session, items)
+def run_task(Task, Session: orm.Session) -> None:
+    """Run a Task that works on the built database (unless it is unchanged,
+    see `stages`)"""
+    def execute():
+        items = Task.setup(Session)
+        Task.run(items, Session)
+    stages.run(Task, Session, execute)
+
+
+# Stages ----------------------------------------------------------------------
+
+# Tasks of the work queue (see `download.work_queue`)
+QUEUE_TASKS = ['personal', 'election', 'speech']
+
+
+def download(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Download profiles, elections, speeches and parliament sessions"""
+    from download.get_personal import PersonalTask, RosterTask
+    from download.get_election import ElectionTask
+    from download.get_speech import SpeechTask
+    from download.get_session import SessionTask
+    from download import client
+    if config['ROSTER']['ENABLED']:
+        PersonalTask = RosterTask
+    for Task in [PersonalTask, ElectionTask, SpeechTask]:
+        if Task is SpeechTask and shards.enabled():
+            # one writer process per shard, which also retries
+            failed = shards.download_shards(Task.setup())
         else:
-            items = Task.setup(Session)
-            Task.run(items, Session)
-    i = input(
-        f'Please checkout the file {config["FILES"]["CLUSTER_WORDS"]} and enter the index of the cluster related to war: ')
+            failed = work_parallel(Task.run, Session, Task.setup())
+            if failed:
+                # second pass once the server had time to recover
+                failed = work_parallel(Task.run, Session, failed)
+            if Task.report:
+                Task.report()
+            client.log_metrics()
+        if failed:
+            logging.error('Giving up on %d items: %s', len(failed), failed)
+    run_task(SessionTask, Session)
+
+
+def enqueue(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Queue the items of the download for `work` and download the
+    parliament sessions"""
+    from download import work_queue
+    from download.get_session import SessionTask
+    if args.retry_dead:
+        print(f'Retrying {work_queue.retry_dead(Session, args.tasks)} dead jobs')
+    else:
+        print(f'Queued {work_queue.enqueue(Session, args.tasks)} new jobs')
+        run_task(SessionTask, Session)
+    print(work_queue.status(Session))
+
+
+def work(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Work on the queued download items (in any number of processes)"""
+    from download import work_queue
+    work_queue.work(Session, args.tasks, args.worker_id)
+    print(work_queue.status(Session))
+
+
+def nlp_service(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Serve the spaCy pipeline to other processes until interrupted"""
+    import time
+    from nlp_service import serve
+    server = serve(args.socket, args.workers)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def sample(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Draw the training sample for clustering"""
+    from processing.sample import SampleTask
+    run_task(SampleTask, Session)
+
+
+def link(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Link speakers to members of parliament"""
+    from processing.link_speech import SpeechLinkTask, GroupedSpeechLinkTask
+    if args.by_parliament or config['SPEECH_CRITERIA']['LINK_BY_PARLIAMENT']:
+        run_task(GroupedSpeechLinkTask, Session)
+    else:
+        run_task(SpeechLinkTask, Session)
+    shards.refresh_aggregates(Session)
+
+
+def cluster(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Fit the cluster model and assign a topic to every speech"""
+    from analysis.speech_clustering import ClusteringTask, IncrementalClusteringTask
+    if args.incremental:
+        run_task(IncrementalClusteringTask, Session)
+    else:
+        run_task(ClusteringTask, Session)
+    shards.refresh_aggregates(Session)
+
+
+def regress(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Build the dataset and run the regression on the war topic"""
+    from analysis.regression_analysis import RegressionTask, GroupedRegressionTask
+    task = GroupedRegressionTask if config['REGRESSION']['GROUPED'] else RegressionTask
+    i = args.war_topic
+    if i is None:
+        i = input(
+            f'Please checkout the file {config["FILES"]["CLUSTER_WORDS"]} and enter the index of the cluster related to war: ')
     logging.info('Received input %s', i)
-    df = RegressionTask.setup(int(i), Session)
-    RegressionTask.run(df)
+
+    def execute():
+        df = task.setup(int(i), Session)
+        task.run(df)
+    stages.run(task, Session, execute, (int(i),))
+
+
+def refilter(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Regenerate the cleaned speech texts from the stored tokens"""
+    from processing.refilter import RefilterTask
+    run_task(RefilterTask, Session)
+
+
+def similar(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Print the speeches closest to a speech or a cluster centroid"""
+    from analysis.speech_clustering import similar_speeches
+    for speech_id, score in similar_speeches(args.speech_id, args.cluster, args.k):
+        print(f'{speech_id}\t{score:.3f}')
+    if args.benchmark:
+        from analysis.speech_clustering import benchmark_index
+        print(benchmark_index(Session))
+
+
+def search(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Print the speeches matching a full-text query"""
+    from analysis.fulltext import create_index, rebuild_index, search as search_speeches
+    create_index(Session)
+    if args.rebuild:
+        rebuild_index(Session)
+    for hit in search_speeches(args.query, Session, args.start, args.end, args.limit):
+        identifiers = ','.join(str(i) for i in hit.identifiers)
+        print(f'{hit.speech_id}\t{hit.speech_date}\t{hit.score:.3f}\t{identifiers}')
+
+
+def run_all(Session: orm.Session, args: argparse.Namespace) -> None:
+    """Run the entire project"""
+    for stage in [download, sample, link, cluster, regress]:
+        stage(Session, args)
+
+
+Stages = {'download': download, 'sample': sample, 'link': link,
+          'cluster': cluster, 'regress': regress, 'refilter': refilter,
+          'similar': similar, 'search': search, 'enqueue': enqueue,
+          'work': work, 'nlp-service': nlp_service, 'all': run_all}
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parse the stage to run (default: all stages)"""
+    parser = argparse.ArgumentParser(prog='code', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.set_defaults(stage='all', war_topic=None, by_parliament=False,
+                        incremental=False)
+    parser.add_argument('--subset', action='store_true',
+                        help='run on the subset defined by SUBSET in the config')
+    parser.add_argument('--subset-start', type=lambda d: date.fromisoformat(d).isoformat(),
+                        help='first day of speeches in the subset (YYYY-MM-DD)')
+    parser.add_argument('--subset-end', type=lambda d: date.fromisoformat(d).isoformat(),
+                        help='last day of speeches in the subset (YYYY-MM-DD)')
+    parser.add_argument('--subset-fraction', type=float,
+                        help='share of members of parliament and days in the subset')
+    parser.add_argument('--force', action='store_true',
+                        help='run stages even if their inputs and config are unchanged')
+    subparsers = parser.add_subparsers(dest='stage')
+    for name, stage in Stages.items():
+        subparser = subparsers.add_parser(name, help=stage.__doc__)
+        if stage in (regress, run_all):
+            subparser.add_argument(
+                '--war-topic', type=int, default=None,
+                help='index of the cluster related to war (prompted otherwise)')
+        if stage is similar:
+            query = subparser.add_mutually_exclusive_group(required=True)
+            query.add_argument('--speech-id', type=int)
+            query.add_argument('--cluster', type=int,
+                               help='index of the cluster centroid')
+            subparser.add_argument('-k', type=int, default=10,
+                                   help='number of speeches (default: 10)')
+            subparser.add_argument('--benchmark', action='store_true',
+                                   help='report recall against exact search')
+        if stage is search:
+            subparser.add_argument('query', help='FTS5 query, e.g. conscription')
+            subparser.add_argument('--start', type=date.fromisoformat,
+                                   help='earliest speech date (YYYY-MM-DD)')
+            subparser.add_argument('--end', type=date.fromisoformat,
+                                   help='latest speech date (YYYY-MM-DD)')
+            subparser.add_argument('--limit', type=int, default=100,
+                                   help='number of speeches (default: 100)')
+            subparser.add_argument('--rebuild', action='store_true',
+                                   help='rebuild the index from the speeches first')
+        if stage in (enqueue, work):
+            subparser.add_argument(
+                '--tasks', nargs='+', choices=QUEUE_TASKS, default=QUEUE_TASKS,
+                help='download Tasks (default: all)')
+        if stage is enqueue:
+            subparser.add_argument('--retry-dead', action='store_true',
+                                   help='make the dead jobs pending again')
+        if stage is work:
+            subparser.add_argument('--worker-id',
+                                   help='name of the worker (default: host:pid)')
+        if stage is nlp_service:
+            subparser.add_argument('--socket', help='path of the socket (default: NLP_SERVICE.SOCKET)')
+            subparser.add_argument('--workers', type=int,
+                                   help='number of processes (default: NLP_SERVICE.WORKERS)')
+        if stage in (cluster, run_all):
+            subparser.add_argument(
+                '--incremental', action='store_true',
+                help='only assign topics to new speeches with the stored model')
+        if stage in (link, run_all):
+            subparser.add_argument(
+                '--by-parliament', action='store_true',
+                help='match speakers only against the members of the parliament')
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
+    apply_subset(args)
+    if args.force:
+        config['STAGES']['SKIP_UNCHANGED'] = False
+    Session = setup_db(Base)
+    Stages[args.stage](Session, args)
 
 
 if __name__ == "__main__":
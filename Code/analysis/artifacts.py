@@ -0,0 +1,170 @@
+"""Storage of the fitted tf-idf vectorizer and cluster model as plain arrays
+instead of pickles: a small JSON header, the vocabulary as a sorted array of
+fixed-width UTF-8 strings and the idf weights and centroids as NumPy files.
+Everything is memory-mapped on loading, so that scoring workers start almost
+instantly and share the pages of the operating system's cache"""
+
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+
+FORMAT = 'speech-model-1'
+
+# parameters of `TfidfVectorizer` which determine the transformation
+PARAMS = ['lowercase', 'strip_accents', 'token_pattern', 'ngram_range',
+          'stop_words', 'norm', 'use_idf', 'smooth_idf', 'sublinear_tf']
+
+# documents transformed at once
+BATCH_SIZE = 10000
+
+
+class CompactVectorizer:
+    """Transform-only replacement of a fitted `TfidfVectorizer`; n-grams are
+    looked up by binary search in the sorted vocabulary"""
+
+    def __init__(self, meta: dict, terms: np.ndarray, idf: np.ndarray):
+        self.meta = meta
+        self.terms = terms  # sorted, fixed-width UTF-8
+        self.idf = idf
+        params = {key: meta[key] for key in PARAMS}
+        params['ngram_range'] = tuple(params['ngram_range'])
+        # without a vocabulary this is cheap to construct
+        self.analyzer = TfidfVectorizer(**params).build_analyzer()
+
+    def get_feature_names_out(self) -> np.ndarray:
+        """Terms in column order"""
+        return np.char.decode(self.terms, 'utf-8').astype(object)
+
+    def lookup(self, grams: list[bytes]) -> tuple[np.ndarray, np.ndarray]:
+        """Columns of the UTF-8 encoded `grams` and whether they were found"""
+        width = self.terms.dtype.itemsize
+        # longer n-grams cannot be in the vocabulary (and would be truncated
+        # by the conversion to fixed width)
+        fits = np.array([len(g) <= width for g in grams], dtype=bool)
+        grams = np.array(grams, dtype=self.terms.dtype)
+        if not len(self.terms):
+            return np.zeros(len(grams), dtype=np.int64), np.zeros(len(grams), dtype=bool)
+        cols = np.searchsorted(self.terms, grams).clip(max=len(self.terms) - 1)
+        return cols, fits & (self.terms[cols] == grams)
+
+    def count(self, documents: list[str]) -> sp.csr_matrix:
+        """Term counts of `documents`"""
+        grams, indptr = [], [0]
+        for document in documents:
+            grams.extend(t.encode('utf-8') for t in self.analyzer(document))
+            indptr.append(len(grams))
+        rows = np.repeat(np.arange(len(documents)), np.diff(indptr))
+        cols, found = self.lookup(grams)
+        counts = sp.coo_matrix(
+            (np.ones(found.sum()), (rows[found], cols[found])),
+            shape=(len(documents), len(self.terms)))
+        return counts.tocsr()  # sums duplicates
+
+    def unknown_share(self, documents: list[str]) -> float:
+        """Share of the words (unigrams) of `documents` which are not in the
+        vocabulary"""
+        words = [t.encode('utf-8') for document in documents
+                 for t in self.analyzer(document) if ' ' not in t]
+        if not words:
+            return 0.0
+        return 1 - self.lookup(words)[1].mean()
+
+    def transform(self, raw_documents) -> sp.csr_matrix:
+        """Tf-idf vectors of `raw_documents` (as `TfidfVectorizer.transform`)"""
+        documents = list(raw_documents)
+        batches = [self.count(documents[i:i + BATCH_SIZE])
+                   for i in range(0, len(documents), BATCH_SIZE)]
+        if not batches:
+            return sp.csr_matrix((0, len(self.terms)))
+        vectors = sp.vstack(batches, format='csr')
+        if self.meta['sublinear_tf']:
+            np.log(vectors.data, vectors.data)
+            vectors.data += 1
+        if self.meta['use_idf']:
+            vectors.data *= self.idf[vectors.indices]
+        if self.meta['norm'] is not None:
+            vectors = normalize(vectors, norm=self.meta['norm'], copy=False)
+        return vectors
+
+
+class CentroidModel:
+    """Predict-only replacement of a fitted `KMeans`"""
+
+    def __init__(self, centroids: np.ndarray):
+        self.cluster_centers_ = centroids
+        self.offsets = 0.5 * (np.asarray(centroids) ** 2).sum(axis=1)
+
+    def predict(self, vectors) -> np.ndarray:
+        """Index of the closest centroid of each row of `vectors`"""
+        # |x - c|^2 = |x|^2 - 2 (x.c - |c|^2 / 2)
+        scores = np.asarray(vectors @ self.cluster_centers_.T) - self.offsets
+        return scores.argmax(axis=1)
+
+    def distance(self, vectors) -> np.ndarray:
+        """Euclidean distance of each row of `vectors` to the closest centroid"""
+        scores = np.asarray(vectors @ self.cluster_centers_.T) - self.offsets
+        norms = np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel() \
+            if sp.issparse(vectors) else (vectors ** 2).sum(axis=1)
+        return np.sqrt(np.maximum(norms - 2 * scores.max(axis=1), 0))
+
+
+def save_vectorizer(vectorizer: TfidfVectorizer, directory: str) -> None:
+    """Store the vocabulary, idf weights and parameters of `vectorizer`"""
+    params = vectorizer.get_params()
+    if params['analyzer'] != 'word' or params['tokenizer'] or params['preprocessor']:
+        raise ValueError('Only the default word analyzer can be stored')
+    terms = vectorizer.get_feature_names_out()
+    encoded = np.array([t.encode('utf-8') for t in terms], dtype=bytes)
+    if len(encoded) > 1 and not (encoded[:-1] < encoded[1:]).all():
+        # `TfidfVectorizer.fit` sorts the features, a fixed vocabulary may not be
+        raise ValueError('The vocabulary has to be sorted')
+    meta = {'format': FORMAT, 'features': len(terms)}
+    meta |= {key: params[key] for key in PARAMS}
+    if isinstance(meta['stop_words'], frozenset):
+        meta['stop_words'] = sorted(meta['stop_words'])
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, 'terms.npy'), encoded)
+    np.save(os.path.join(directory, 'idf.npy'),
+            vectorizer.idf_ if params['use_idf'] else np.ones(len(terms)))
+    with open(os.path.join(directory, 'vectorizer.json'), mode='w', encoding='utf-8') as file:
+        json.dump(meta, file, indent=2)
+
+
+def load_vectorizer(directory: str) -> CompactVectorizer:
+    """Load a vectorizer stored by `save_vectorizer`"""
+    with open(os.path.join(directory, 'vectorizer.json'), encoding='utf-8') as file:
+        meta = json.load(file)
+    if meta['format'] != FORMAT:
+        raise ValueError(f'Unknown model format {meta["format"]}')
+    terms = np.load(os.path.join(directory, 'terms.npy'), mmap_mode='r')
+    idf = np.load(os.path.join(directory, 'idf.npy'), mmap_mode='r')
+    return CompactVectorizer(meta, terms, idf)
+
+
+def save_centroids(model, directory: str) -> None:
+    """Store the cluster centers of `model` (e.g. a fitted `KMeans`)"""
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, 'centroids.npy'), model.cluster_centers_)
+
+
+def load_centroids(directory: str) -> CentroidModel:
+    """Load a cluster model stored by `save_centroids`"""
+    return CentroidModel(np.load(os.path.join(directory, 'centroids.npy'), mmap_mode='r'))
+
+
+def save_stats(stats: dict, directory: str) -> None:
+    """Store statistics of the fitted models (e.g. for measuring drift)"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'stats.json'), mode='w', encoding='utf-8') as file:
+        json.dump(stats, file, indent=2)
+
+
+def load_stats(directory: str) -> dict:
+    """Load the statistics stored by `save_stats`"""
+    with open(os.path.join(directory, 'stats.json'), encoding='utf-8') as file:
+        return json.load(file)
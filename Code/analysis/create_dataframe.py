@@ -5,9 +5,10 @@ from collections.abc import Callable
 import pandas as pd
 import sqlalchemy as sql
 import sqlalchemy.orm as orm
-from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql.expression import and_, or_
 
-from models import Personal, Speech, SpeechLink, TopicPrediction, Membership, ElectionCandidate, ParliamentSession
+from models import (Personal, Speech, SpeechLink, TopicPrediction, Membership,
+                    ElectionCandidate, ParliamentSession, TopicCount, TopicMonth)
 from config import config
 from helpers import Task, sql_get, logged
 
@@ -124,16 +125,20 @@ def get_speech_df(war_topic: int, session: orm.Session):
     """Query speech data and create war topic dummy"""
     date_condition = and_(ParliamentSession.start_date <= Speech.speech_date,
                           ParliamentSession.end_date >= Speech.speech_date)
+    # links without parliament are valid in every parliament
+    link_condition = and_(Speech.speaker_id == SpeechLink.speaker_id,
+                          or_(SpeechLink.parliament.is_(None),
+                              SpeechLink.parliament == ParliamentSession.parliament))
     stmt = sql.Select(Speech.speaker_party, TopicPrediction.topic,
                       SpeechLink.identifier, ParliamentSession.parliament).join(
         TopicPrediction).join(
+        ParliamentSession,
+        onclause=date_condition).join(
         SpeechLink,
-        onclause=Speech.speaker_name == SpeechLink.name).join(
+        onclause=link_condition).join(
         Personal,
         onclause=SpeechLink.identifier == Personal.identifier,
-        isouter=True).join(
-        ParliamentSession,
-        onclause=date_condition)
+        isouter=True)
     columns = ['speaker_party', 'topic', 'personal_id', 'parliament']
     data = sql_get(stmt, session)
     df = pd.DataFrame(data, columns=columns)
@@ -142,6 +147,36 @@ def get_speech_df(war_topic: int, session: orm.Session):
     return df
 
 
+def get_speech_agg_df(war_topic: int, session: orm.Session):
+    """Number of speeches and of war speeches and their share (`topic`) per
+    member of parliament and parliament, read from the aggregate table (the
+    same rows as `get_speech_df`, grouped)"""
+    stmt = sql.Select(TopicCount.identifier, TopicCount.parliament,
+                      TopicCount.topic, TopicCount.speeches).where(
+        TopicCount.speeches > 0)
+    columns = ['personal_id', 'parliament', 'topic', 'speeches']
+    df = pd.DataFrame(sql_get(stmt, session), columns=columns)
+    return aggregate_war_share(df, war_topic, ['personal_id', 'parliament'])
+
+
+def get_month_df(war_topic: int, session: orm.Session):
+    """Number of speeches and of war speeches and their share (`topic`) per
+    month (YYYY-MM), read from the aggregate table"""
+    stmt = sql.Select(TopicMonth.month, TopicMonth.topic,
+                      TopicMonth.speeches).where(TopicMonth.speeches > 0)
+    df = pd.DataFrame(sql_get(stmt, session), columns=['month', 'topic', 'speeches'])
+    return aggregate_war_share(df, war_topic, ['month'])
+
+
+def aggregate_war_share(df: pd.DataFrame, war_topic: int, by: list[str]) -> pd.DataFrame:
+    """Sum the speech counts per topic to counts of all and of war speeches"""
+    df['war_speeches'] = [is_war_speech(topic, war_topic) * n
+                          for topic, n in zip(df['topic'], df['speeches'])]
+    df = df.groupby(by, as_index=False)[['speeches', 'war_speeches']].sum()
+    df['topic'] = df['war_speeches'] / df['speeches']
+    return df
+
+
 @ logged
 def get_all_data(war_topic: int, session: orm.Session) -> tuple[pd.DataFrame]:
     """Execute calls to obtain all datasets"""
@@ -169,6 +204,27 @@ def create_df(items: tuple[pd.DataFrame]):
 DatasetTask = Task(get_all_data, create_df, None)
 
 
+# Grouped ---------------------------------------------------------------------
+
+@ logged
+def get_grouped_data(war_topic: int, session: orm.Session) -> tuple[pd.DataFrame]:
+    """As `get_all_data`, but with the speeches counted per member of
+    parliament and parliament (cells of `analysis.grouped_ols`)"""
+    elec = get_elec_df(session)
+    pers_memb = get_pers_memb_df(session)
+    speech = get_speech_agg_df(war_topic, session).astype(
+        {'personal_id': int, 'parliament': int})
+    # the war topic dummy is 0 or 1, its sum of squares is its sum
+    speech = speech.rename(columns={'speeches': 'n', 'war_speeches': 'y_sum'})
+    speech['y_sq_sum'] = speech['y_sum']
+    return elec, pers_memb, speech.drop('topic', axis=1)
+
+
+# the join repeats a cell for every row of the dataset of a person, as the
+# speeches are repeated in `DatasetTask`, which keeps their weights equal
+GroupedDatasetTask = Task(get_grouped_data, create_df, None)
+
+
 # Alternative -- 1 single database query ---------------------------------------
 
 
@@ -184,7 +240,7 @@ DatasetTask = Task(get_all_data, create_df, None)
 #                       ps.end_date >= s.speech_date)
 
 # subq = sql.Select(s.speaker_party, tp.topic, sl.identifier, ps.parliament).join(
-#     tp).join(sl, onclause=s.speaker_name == sl.name).join(
+#     tp).join(sl, onclause=s.speaker_id == sl.speaker_id).join(
 #         ps, onclause=date_condition).subquery()
 
 # # person x parliament conditions
@@ -0,0 +1,90 @@
+"""Keyword search in the speeches through the SQLite FTS5 index `speech_fts`
+(see `models.SPEECH_FTS`), ranked by BM25. The index contains the cleaned
+speeches, i.e. queries have to consist of lemmas of the kept word types
+(lower case). If the speeches are sharded, each shard has its own index
+(created with the shard) and the shards are searched together"""
+
+from collections import namedtuple
+from datetime import date
+
+import sqlalchemy as sql
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import and_, or_
+
+from models import Speech, SpeechLink, ParliamentSession, SPEECH_FTS
+from helpers import sql_get, logged
+from shards import enabled, schemas
+
+
+# score: BM25 relevance (higher is better)
+Hit = namedtuple('Hit', ['speech_id', 'speech_date', 'score', 'identifiers'])
+
+fts = sql.literal_column('speech_fts')
+
+
+@logged
+def create_index(session: Session) -> None:
+    """Create the index and its triggers in a database created before they
+    existed and fill it"""
+    if enabled():
+        return
+    exists = sql_get(sql.text("SELECT 1 FROM sqlite_master WHERE name = 'speech_fts'"),
+                     session)
+    for statement in SPEECH_FTS:
+        session.execute(sql.text(statement))
+    if not exists:
+        rebuild_index(session)
+    session.commit()
+
+
+@logged
+def rebuild_index(session: Session) -> None:
+    """Rebuild the index from the `speech` table (of each shard)"""
+    for schema in schemas():
+        table = f'{schema}.speech_fts' if schema else 'speech_fts'
+        session.execute(sql.text(f"INSERT INTO {table} (speech_fts) VALUES ('rebuild')"))
+    session.commit()
+
+
+def match(query: str, schema: str | None, start: date | None,
+          end: date | None) -> sql.Select:
+    """Ids and BM25 scores of the speeches matching `query` in the index of
+    `schema`"""
+    speech_fts = sql.table('speech_fts', sql.column('rowid'), schema=schema).alias('speech_fts')
+    score = sql.func.bm25(fts)
+    hits = sql.select(speech_fts.c.rowid.label('speech_id'),
+                      score.label('score')).where(fts.op('MATCH')(query))
+    if start is not None or end is not None:
+        hits = hits.join(Speech, Speech.speech_id == speech_fts.c.rowid)
+        if start is not None:
+            hits = hits.where(Speech.speech_date >= start)
+        if end is not None:
+            hits = hits.where(Speech.speech_date <= end)
+    return hits
+
+
+def search(query: str, session: Session, start: date | None = None,
+           end: date | None = None, limit: int | None = 100) -> list[Hit]:
+    """Speeches (between `start` and `end`) matching the FTS5 `query` (e.g.
+    'conscription', 'war NOT korea' or '"air force"'), best first, with the
+    identifiers of the linked members of parliament"""
+    arms = [match(query, schema, start, end) for schema in schemas()]
+    hits = arms[0] if len(arms) == 1 else sql.union_all(*arms).subquery().select()
+    hits = hits.order_by(sql.literal_column('score')).limit(limit).subquery()
+    date_condition = and_(ParliamentSession.start_date <= Speech.speech_date,
+                          ParliamentSession.end_date >= Speech.speech_date)
+    link_condition = and_(Speech.speaker_id == SpeechLink.speaker_id,
+                          or_(SpeechLink.parliament.is_(None),
+                              SpeechLink.parliament == ParliamentSession.parliament))
+    stmt = sql.select(hits.c.speech_id, Speech.speech_date, hits.c.score,
+                      SpeechLink.identifier).join(
+        Speech, Speech.speech_id == hits.c.speech_id).join(
+        ParliamentSession, onclause=date_condition, isouter=True).join(
+        SpeechLink, onclause=link_condition, isouter=True).order_by(
+        hits.c.score, hits.c.speech_id)
+    found: dict[int, Hit] = {}
+    for speech_id, speech_date, score, identifier in sql_get(stmt, session):
+        hit = found.setdefault(speech_id, Hit(speech_id, speech_date, -score, []))
+        if identifier is not None and identifier not in hit.identifiers:
+            hit.identifiers.append(identifier)
+    return list(found.values())
@@ -0,0 +1,113 @@
+"""OLS from grouped sufficient statistics: rows which share all regressors
+(e.g. the speeches of a member of parliament in a parliament) are collapsed to
+one cell with their number `n`, the sum `y_sum` and the sum of squares
+`y_sq_sum` of the dependent variable. The weighted normal equations of the
+cells give the same coefficients and (robust or clustered) standard errors as
+the fit on the rows"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import patsy
+from scipy import stats
+
+from helpers import logged
+
+
+GroupedOLSResult = namedtuple('GroupedOLSResult', ['params', 'bse', 'cov', 'nobs', 'df_resid',
+                                                   'rsquared', 'cov_type', 'n_groups'])
+
+COV_TYPES = ['nonrobust', 'HC1', 'cluster']
+
+
+def collapse(df: pd.DataFrame, y: str, columns: list[str]) -> pd.DataFrame:
+    """Cells of the rows of `df` with equal `columns` (the regressors and the
+    cluster variable) and their sufficient statistics of `y`"""
+    cells = df.assign(y_sq=df[y] ** 2).groupby(columns, as_index=False, dropna=False).agg(
+        n=(y, 'size'), y_sum=(y, 'sum'), y_sq_sum=('y_sq', 'sum'))
+    return cells
+
+
+def fit(cells: pd.DataFrame, formula: str, cov_type: str = 'nonrobust',
+        groups: str | None = None) -> GroupedOLSResult:
+    """Fit the right hand side of `formula` to the cells (columns `n`, `y_sum`
+    and `y_sq_sum`) with the covariance `cov_type` (see COV_TYPES; clustered by
+    the column `groups`, which has to be constant within each cell)"""
+    if cov_type not in COV_TYPES:
+        raise ValueError(f'Unknown cov_type {cov_type}, use one of {COV_TYPES}')
+    if cov_type == 'cluster' and groups is None:
+        raise ValueError('cov_type cluster requires groups')
+    cells = cells.reset_index(drop=True)
+    X = patsy.dmatrix(formula.split('~', 1)[-1], cells, return_type='dataframe')
+    # patsy drops the cells with missing regressors
+    cells = cells.loc[X.index]
+    x = X.to_numpy(dtype=np.float64)
+    n = cells['n'].to_numpy(dtype=np.float64)
+    s = cells['y_sum'].to_numpy(dtype=np.float64)
+    q = cells['y_sq_sum'].to_numpy(dtype=np.float64)
+    # the rows of a cell weighted by the root of its number, solved by the
+    # pseudo-inverse as statsmodels (also for rank deficient designs)
+    root = np.sqrt(n)
+    weighted = x * root[:, None]
+    pinv = np.linalg.pinv(weighted)
+    singular = np.linalg.svd(weighted, compute_uv=False)
+    bread = pinv @ pinv.T
+    params = pinv @ (s / root)
+    nobs = n.sum()
+    k = int((singular > singular.max() * max(x.shape) * np.finfo(float).eps).sum())
+    fitted = x @ params
+    # residual sum of squares and scores of the rows of each cell
+    ssr = q - 2 * fitted * s + n * fitted ** 2
+    scores = x * (s - n * fitted)[:, None]
+    df_resid = nobs - k
+    n_groups = None
+    if cov_type == 'nonrobust':
+        cov = bread * ssr.sum() / df_resid
+    elif cov_type == 'HC1':
+        meat = x.T @ (x * ssr[:, None])
+        cov = bread @ meat @ bread * nobs / df_resid
+    else:
+        codes, uniques = pd.factorize(cells[groups])
+        n_groups = len(uniques)
+        group_scores = np.zeros((n_groups, x.shape[1]))
+        np.add.at(group_scores, codes, scores)
+        # G/(G-1) (N-1)/(N-K) with the number of columns K (not the rank) as
+        # statsmodels
+        correction = n_groups / (n_groups - 1) * (nobs - 1) / (nobs - x.shape[1])
+        cov = bread @ (group_scores.T @ group_scores) @ bread * correction
+    tss = q.sum() - s.sum() ** 2 / nobs
+    return GroupedOLSResult(params=pd.Series(params, index=X.columns),
+                            bse=pd.Series(np.sqrt(np.diag(cov)), index=X.columns),
+                            cov=pd.DataFrame(cov, index=X.columns, columns=X.columns),
+                            nobs=int(nobs), df_resid=df_resid,
+                            rsquared=1 - ssr.sum() / tss,
+                            cov_type=cov_type, n_groups=n_groups)
+
+
+def summary(result: GroupedOLSResult, alpha: float = 0.05) -> pd.DataFrame:
+    """Table of the coefficients (t distribution for nonrobust standard
+    errors, normal otherwise, as statsmodels)"""
+    statistic = result.params / result.bse
+    if result.cov_type == 'nonrobust':
+        name, dist = 't', stats.t(result.df_resid)
+    else:
+        name, dist = 'z', stats.norm()
+    critical = dist.ppf(1 - alpha / 2)
+    return pd.DataFrame({'coef': result.params, 'std err': result.bse,
+                         name: statistic,
+                         f'P>|{name}|': 2 * dist.sf(np.abs(statistic)),
+                         f'[{alpha / 2}': result.params - critical * result.bse,
+                         f'{1 - alpha / 2}]': result.params + critical * result.bse})
+
+
+@logged
+def fit_grouped(cells: pd.DataFrame, formula: str, cov_type: str = 'nonrobust',
+                groups: str | None = None) -> GroupedOLSResult:
+    """Fit and print the summary of the regression"""
+    result = fit(cells, formula, cov_type, groups)
+    print(f'Grouped OLS of {formula}: {result.nobs} observations in {len(cells)} cells, '
+          f'R-squared {result.rsquared:.4f}, covariance {cov_type}'
+          + (f' ({result.n_groups} clusters)' if result.n_groups else ''))
+    print(summary(result).to_string())
+    return result
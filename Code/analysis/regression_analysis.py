@@ -2,8 +2,15 @@ import pandas as pd
 import sqlalchemy.orm as orm
 import statsmodels.formula.api as smf
 
-from analysis.create_dataframe import DatasetTask
+from analysis.create_dataframe import DatasetTask, GroupedDatasetTask
+from analysis import grouped_ols
+from models import (Personal, Membership, ElectionCandidate, Speech, SpeechLink,
+                    TopicPrediction, ParliamentSession, TopicCount)
 from helpers import Task, logged
+from config import config
+
+
+FORMULA = 'topic ~ close_election'
 
 
 @logged
@@ -20,9 +27,38 @@ def create_baseline_reg(df: pd.DataFrame):
     print(df['topic'].mean())
     print(df.groupby('close_election')['topic'].mean())
     base_reg = smf.ols(
-        'topic ~ close_election', data=df)
+        FORMULA, data=df)
     res = base_reg.fit()
     print(res.summary())
 
 
-RegressionTask = Task(get_df, create_baseline_reg, None)
+@logged
+def get_grouped_df(i: int, session: orm.Session):
+    """Create the dataset with one row per member of parliament and parliament"""
+    items = GroupedDatasetTask.setup(i, session)
+    df = GroupedDatasetTask.run(items)
+    return df
+
+
+@logged
+def create_grouped_reg(df: pd.DataFrame):
+    """The regression of `create_baseline_reg` from the speeches counted per
+    member of parliament and parliament"""
+    settings = config['REGRESSION']
+    print(df['y_sum'].sum() / df['n'].sum())
+    by_close = df.groupby('close_election')[['y_sum', 'n']].sum()
+    print(by_close['y_sum'] / by_close['n'])
+    groups = settings['CLUSTER'] if settings['COV_TYPE'] == 'cluster' else None
+    grouped_ols.fit_grouped(df, FORMULA, settings['COV_TYPE'], groups)
+
+
+RegressionTask = Task(get_df, create_baseline_reg, None,
+                      config=['DATA.COMMITTEE_KEYWORDS', 'DATA.PROFESSION_KEYWORDS',
+                              'DATA.VOTE_SHARE_THRESHOLD'],
+                      inputs=[Personal, Membership, ElectionCandidate, Speech,
+                              SpeechLink, TopicPrediction, ParliamentSession])
+
+GroupedRegressionTask = Task(get_grouped_df, create_grouped_reg, None,
+                             config=RegressionTask.config + ['REGRESSION.COV_TYPE',
+                                                             'REGRESSION.CLUSTER'],
+                             inputs=RegressionTask.inputs + [TopicCount])
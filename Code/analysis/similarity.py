@@ -0,0 +1,190 @@
+"""Approximate nearest neighbour search for speeches (e.g. the speeches closest
+to a given speech or a cluster centroid) by LSH over a latent semantic
+(truncated SVD) embedding of the tf-idf vectors"""
+
+import logging
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+
+from config import config
+
+
+class SpeechIndex:
+    """The tf-idf vectors, restricted to the most frequent terms, are embedded
+    by a truncated SVD (fitted on a sample of speeches) and normalized; each of
+    several hash tables buckets them by the signs of random hyperplanes.
+    Candidates from the query's bucket and its neighbours (one bit flipped) are
+    ranked by the cosine similarity of their tf-idf vectors (or of the
+    embeddings if the vectors are not kept).
+
+    Random projections of the tf-idf vectors themselves preserve too little of
+    the (low) similarities between speeches for hashing, the SVD concentrates
+    the shared vocabulary of a topic in a few dimensions"""
+
+    def __init__(self, speech_ids: np.ndarray, features: np.ndarray,
+                 components: np.ndarray, embeddings: np.ndarray, planes: np.ndarray,
+                 codes: np.ndarray, order: np.ndarray,
+                 vectors: sp.csr_matrix | None = None):
+        self.speech_ids = speech_ids
+        self.features = features      # columns of the vocabulary used
+        self.components = components  # (dimensions x features)
+        self.embeddings = embeddings  # (speeches x dimensions), normalized
+        self.planes = planes          # (tables x dimensions x bits)
+        self.codes = codes            # (tables x speeches), sorted per table
+        self.order = order            # (tables x speeches), row of each code
+        self.vectors = vectors        # (speeches x vocabulary), normalized
+        self.rows = {s: i for i, s in enumerate(speech_ids.tolist())}
+
+    @classmethod
+    def build(cls, speech_ids, vectors) -> "SpeechIndex":
+        """Index the tf-idf `vectors` (rows) of `speech_ids`"""
+        settings = config['SIMILARITY']
+        rng = np.random.default_rng(settings['SEED'])
+        vectors = normalize(sp.csr_matrix(vectors, dtype=np.float32))
+        frequency = np.bincount(vectors.indices, minlength=vectors.shape[1])
+        features = np.sort(np.argsort(-frequency, kind='stable')[:settings['FEATURES']])
+        sample = rng.choice(vectors.shape[0], replace=False,
+                            size=min(settings['SAMPLE'], vectors.shape[0]))
+        dimensions = min(settings['DIMENSIONS'], len(features) - 1, len(sample) - 1)
+        svd = TruncatedSVD(dimensions, random_state=settings['SEED'])
+        svd.fit(vectors[np.sort(sample)][:, features])
+        planes = rng.standard_normal(
+            (settings['TABLES'], dimensions, settings['BITS'])).astype(np.float32)
+        index = cls(np.asarray(speech_ids), features,
+                    svd.components_.astype(np.float32), None, planes, None, None)
+        if settings['KEEP_VECTORS']:
+            index.vectors = vectors
+        index.embeddings = index.embed(vectors)
+        hashed = index.hash(index.embeddings)
+        index.order = np.argsort(hashed, axis=1, kind='stable')
+        index.codes = np.take_along_axis(hashed, index.order, axis=1)
+        return index
+
+    def add(self, speech_ids, vectors) -> None:
+        """Add the tf-idf `vectors` (rows) of `speech_ids` to the index (the
+        embedding is not refitted)"""
+        vectors = normalize(sp.csr_matrix(vectors, dtype=np.float32))
+        self.speech_ids = np.concatenate([self.speech_ids, np.asarray(speech_ids)])
+        self.embeddings = np.vstack([self.embeddings, self.embed(vectors)])
+        if self.vectors is not None:
+            self.vectors = sp.vstack([self.vectors, vectors], format='csr')
+        hashed = self.hash(self.embeddings)
+        self.order = np.argsort(hashed, axis=1, kind='stable')
+        self.codes = np.take_along_axis(hashed, self.order, axis=1)
+        self.rows = {s: i for i, s in enumerate(self.speech_ids.tolist())}
+
+    def embed(self, vectors) -> np.ndarray:
+        """Embed and normalize tf-idf vectors (sparse rows or dense)"""
+        if sp.issparse(vectors):
+            embedded = vectors.tocsc()[:, self.features] @ self.components.T
+        else:
+            embedded = np.atleast_2d(vectors)[:, self.features] @ self.components.T
+        embedded = np.asarray(embedded, dtype=np.float32)
+        norms = np.linalg.norm(embedded, axis=1, keepdims=True)
+        return embedded / np.where(norms == 0, 1, norms)
+
+    def hash(self, embeddings: np.ndarray) -> np.ndarray:
+        """Bucket codes (tables x rows)"""
+        bits = np.einsum('nd,tdb->tnb', embeddings, self.planes) > 0
+        weights = 1 << np.arange(self.planes.shape[2], dtype=np.int64)
+        return (bits * weights).sum(axis=2)
+
+    def candidates(self, embedding: np.ndarray) -> np.ndarray:
+        """Rows in the buckets of `embedding` and their neighbours"""
+        codes = self.hash(embedding[None, :])[:, 0]
+        flips = np.concatenate(
+            [[0], 1 << np.arange(self.planes.shape[2], dtype=np.int64)])
+        found = []
+        for t, code in enumerate(codes):
+            probes = code ^ flips
+            starts = np.searchsorted(self.codes[t], probes, side='left')
+            ends = np.searchsorted(self.codes[t], probes, side='right')
+            found.extend(self.order[t, s:e] for s, e in zip(starts, ends) if e > s)
+        if not found:
+            return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def rank(self, rows: np.ndarray, embedding: np.ndarray, vector: np.ndarray,
+             k: int) -> list[tuple[int, float]]:
+        """Top `k` (speech_id, cosine similarity) pairs among `rows`"""
+        if self.vectors is not None:
+            scores = self.vectors[rows] @ vector
+        else:
+            scores = self.embeddings[rows] @ embedding
+        best = np.argsort(-scores)[:k]
+        return [(int(self.speech_ids[rows[i]]), float(scores[i])) for i in best]
+
+    def query(self, vector, k: int = 10) -> list[tuple[int, float]]:
+        """Top `k` (speech_id, cosine similarity) pairs for a tf-idf vector
+        (sparse row or dense, e.g. a cluster centroid)"""
+        embedding = self.embed(vector)[0]
+        if sp.issparse(vector):
+            vector = vector.toarray()
+        vector = normalize(np.atleast_2d(vector).astype(np.float32))[0]
+        return self.rank(self.candidates(embedding), embedding, vector, k)
+
+    def query_speech(self, speech_id: int, k: int = 10) -> list[tuple[int, float]]:
+        """Top `k` speeches similar to the speech `speech_id` (excluding it)"""
+        row = self.rows[speech_id]
+        embedding = self.embeddings[row]
+        rows = self.candidates(embedding)
+        rows = rows[rows != row]
+        vector = self.vectors[row].toarray()[0] if self.vectors is not None else None
+        return self.rank(rows, embedding, vector, k)
+
+    def save(self, path: str) -> None:
+        """Store the index as a single .npz file"""
+        arrays = {}
+        if self.vectors is not None:
+            arrays = {'vec_data': self.vectors.data,
+                      'vec_indices': self.vectors.indices,
+                      'vec_indptr': self.vectors.indptr,
+                      'vec_shape': np.array(self.vectors.shape)}
+        np.savez(path, speech_ids=self.speech_ids, features=self.features,
+                 components=self.components, planes=self.planes,
+                 embeddings=self.embeddings, codes=self.codes, order=self.order,
+                 **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "SpeechIndex":
+        """Load an index stored by `save`"""
+        with np.load(path) as f:
+            vectors = sp.csr_matrix(
+                (f['vec_data'], f['vec_indices'], f['vec_indptr']),
+                shape=tuple(f['vec_shape'])) if 'vec_data' in f else None
+            return cls(f['speech_ids'], f['features'], f['components'],
+                       f['embeddings'], f['planes'], f['codes'], f['order'],
+                       vectors)
+
+
+def exact_top_k(vectors, row: int, k: int) -> np.ndarray:
+    """Rows of the `k` vectors most similar to row `row` (excluding it)"""
+    scores = (vectors @ vectors[row].T).toarray().ravel()
+    scores[row] = -np.inf
+    return np.argsort(-scores)[:k]
+
+
+def benchmark(index: SpeechIndex, vectors, queries: int = 100, k: int = 10) -> dict:
+    """Recall@k of the index against exact search over the (normalized)
+    tf-idf `vectors` for randomly chosen speeches, and time per query"""
+    rng = np.random.default_rng(1)
+    rows = rng.choice(len(index.speech_ids), size=min(queries, len(index.speech_ids)),
+                      replace=False)
+    hits, ann_time, exact_time = 0, 0.0, 0.0
+    for row in rows:
+        start = time.perf_counter()
+        approx = index.query_speech(int(index.speech_ids[row]), k)
+        ann_time += time.perf_counter() - start
+        start = time.perf_counter()
+        exact = exact_top_k(vectors, row, k)
+        exact_time += time.perf_counter() - start
+        hits += len({s for s, _ in approx} & set(index.speech_ids[exact].tolist()))
+    result = {'recall': hits / (len(rows) * k),
+              'ann_ms': 1000 * ann_time / len(rows),
+              'exact_ms': 1000 * exact_time / len(rows)}
+    logging.getLogger('benchmark').info('Speech index: %s', result)
+    return result
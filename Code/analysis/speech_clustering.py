@@ -1,14 +1,20 @@
 """Vectorizing speeches in order to create clusters"""
 
 
-import pickle
+import logging
+import os
 
 from sqlalchemy import Select
 from sqlalchemy.orm import Session
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.cluster import KMeans
 
-from models import Speech, Sample, TopicPrediction
+from analysis.artifacts import (CentroidModel, CompactVectorizer, save_vectorizer,
+                                load_vectorizer, save_centroids, load_centroids,
+                                save_stats, load_stats)
+from analysis.similarity import SpeechIndex, benchmark
+from analysis.tfidf import fit_parallel
+from models import Speech, Sample, TopicPrediction, replace_topic_predictions
 from helpers import Task, sql_get, logged
 from config import config
 
@@ -33,6 +39,14 @@ def get_all_speeches(session: Session) -> list[tuple[int, str]]:
     return items
 
 
+@logged
+def get_new_speeches(session: Session) -> list[tuple[int, str]]:
+    """Obtain identifier, text pairs of Speeches without a TopicPrediction"""
+    stmt = Select(Speech.speech_id, Speech.speech_text).join(
+        TopicPrediction, isouter=True).where(TopicPrediction.speech_id.is_(None))
+    return sql_get(stmt, session)
+
+
 @logged
 def get_sample(session: Session) -> tuple[int, str]:
     """Obtain identifier, text pairs for Speeches in the sample"""
@@ -49,10 +63,16 @@ def vectorize_speeches(items: list[tuple[int, str]]) -> TfidfVectorizer:
     """Fit tf-idf vectorizer on `items`"""
     speeches = [i[1] for i in items]
     ngrams = config['SPEECH_CRITERIA']['NGRAMS']
-    vectorizer = TfidfVectorizer(input='content', ngram_range=(1, ngrams))
-    vectorizer.fit(speeches)
-    with open(config['FILES']['VECTORIZER_PATH'], mode='wb') as file:
-        pickle.dump(vectorizer, file)
+    settings = config['TFIDF']
+    params = {'input': 'content', 'ngram_range': (1, ngrams),
+              'min_df': settings['MIN_DF'], 'max_df': settings['MAX_DF'],
+              'max_features': settings['MAX_FEATURES']}
+    if settings['WORKERS'] == 1:
+        vectorizer = TfidfVectorizer(**params).fit(speeches)
+    else:
+        vectorizer = fit_parallel(speeches, params, settings['WORKERS'],
+                                  settings['CHUNK_SIZE'])
+    save_vectorizer(vectorizer, config['FILES']['MODEL_DIR'])
     return vectorizer
 
 
@@ -68,8 +88,7 @@ def train_model(items: list[str], vectorizer: TfidfVectorizer) -> KMeans:
     word_scores = vectorizer.transform(items)
     model = KMeans(n_clusters=n, init='k-means++', n_init=10, random_state=1)
     model.fit(word_scores)
-    with open(config['FILES']['KMEANS_PATH'], mode='wb') as file:
-        pickle.dump(model, file)
+    save_centroids(model, config['FILES']['MODEL_DIR'])
     return model
 
 
@@ -78,6 +97,15 @@ TrainTask = Task(get_sample, train_model, None)
 
 # Prediction ------------------------------------------------------------------
 
+def save_topics(speech_ids: list[int], speech_topics, session: Session) -> None:
+    """Store the predicted topics"""
+    for speech_prediction in zip(speech_ids, speech_topics):
+        instance = TopicPrediction(
+            speech_id=speech_prediction[0], topic=int(speech_prediction[1]))
+        session.add(instance)
+    session.commit()
+
+
 @logged
 def assign_topics(items: tuple[int, str], session: Session):
     """Assigns a topic to every speech, executing `VectorizeTask` and
@@ -89,11 +117,93 @@ def assign_topics(items: tuple[int, str], session: Session):
     inspect_model(model, vectorizer)
     scores = vectorizer.transform(i[1] for i in items)
     speech_topics = model.predict(scores)
-    for speech_prediction in zip([i[0] for i in items], speech_topics):
-        instance = TopicPrediction(
-            speech_id=speech_prediction[0], topic=int(speech_prediction[1]))
-        session.add(instance)
+    # reference for the drift of later speeches (see `measure_drift`)
+    distance = CentroidModel(model.cluster_centers_).distance(scores)
+    save_stats({'speeches': len(items), 'distance': float(distance.mean())},
+               config['FILES']['MODEL_DIR'])
+    index = SpeechIndex.build([i[0] for i in items], scores)
+    index.save(config['FILES']['SPEECH_INDEX'])
+    # predictions of an earlier fit are replaced in bulk, the aggregates are
+    # rebuilt once instead of by the triggers of each row
+    replace_topic_predictions([{'speech_id': i[0], 'topic': int(topic)}
+                               for i, topic in zip(items, speech_topics)], session.connection())
     session.commit()
 
 
-ClusteringTask = Task(get_all_speeches, assign_topics, TopicPrediction)
+ClusteringTask = Task(get_all_speeches, assign_topics, TopicPrediction,
+                      config=['SPEECH_CRITERIA.NGRAMS', 'SPEECH_CRITERIA.CLUSTERS',
+                              'TFIDF.MIN_DF', 'TFIDF.MAX_DF',
+                              'TFIDF.MAX_FEATURES', 'SIMILARITY',
+                              'FILES.MODEL_DIR', 'FILES.SPEECH_INDEX',
+                              'FILES.CLUSTER_WORDS'],
+                      inputs=[Speech, Sample])
+
+
+# Incremental prediction ------------------------------------------------------
+
+def measure_drift(texts: list[str], scores, vectorizer: CompactVectorizer,
+                  model: CentroidModel) -> dict[str, float]:
+    """Share of unknown words in `texts` and mean distance of their vectors
+    `scores` to the closest centroid relative to the speeches of the fit"""
+    stats = load_stats(config['FILES']['MODEL_DIR'])
+    distance = float(model.distance(scores).mean())
+    return {'new_vocabulary': float(vectorizer.unknown_share(texts)),
+            'distance_ratio': distance / stats['distance'] if stats['distance'] else 1.0}
+
+
+@logged
+def assign_new_topics(items: list[tuple[int, str]], session: Session):
+    """Assigns a topic to the speeches without one using the stored model,
+    unless the new speeches drifted too far from the fitted ones (see DRIFT in
+    the config), which triggers a full refit"""
+    logger = logging.getLogger('assign_new_topics')
+    if not items:
+        return
+    if not os.path.exists(os.path.join(config['FILES']['MODEL_DIR'], 'stats.json')):
+        logger.info('No stored model, fitting')
+        ClusteringTask.run(ClusteringTask.setup(session), session)
+        return
+    vectorizer = load_vectorizer(config['FILES']['MODEL_DIR'])
+    model = load_centroids(config['FILES']['MODEL_DIR'])
+    texts = [i[1] for i in items]
+    scores = vectorizer.transform(texts)
+    drift = measure_drift(texts, scores, vectorizer, model)
+    logger.info('Drift of %d new speeches: %s', len(items), drift)
+    thresholds = config['DRIFT']
+    if (drift['new_vocabulary'] > thresholds['NEW_VOCABULARY']
+            or drift['distance_ratio'] > thresholds['DISTANCE_RATIO']):
+        logger.info('Drift above the thresholds, refitting')
+        ClusteringTask.run(ClusteringTask.setup(session), session)
+        return
+    if os.path.exists(config['FILES']['SPEECH_INDEX']):
+        index = SpeechIndex.load(config['FILES']['SPEECH_INDEX'])
+        index.add([i[0] for i in items], scores)
+        index.save(config['FILES']['SPEECH_INDEX'])
+    save_topics([i[0] for i in items], model.predict(scores), session)
+
+
+IncrementalClusteringTask = Task(get_new_speeches, assign_new_topics, TopicPrediction,
+                                 config=['DRIFT', 'FILES.MODEL_DIR', 'FILES.SPEECH_INDEX'],
+                                 inputs=[Speech])
+
+
+# Similar speeches ------------------------------------------------------------
+
+def similar_speeches(speech_id: int | None, cluster: int | None, k: int) -> list[tuple[int, float]]:
+    """Speeches closest to the speech `speech_id` or to the centroid of
+    `cluster`, using the index stored by `assign_topics`"""
+    index = SpeechIndex.load(config['FILES']['SPEECH_INDEX'])
+    if speech_id is not None:
+        return index.query_speech(speech_id, k)
+    model = load_centroids(config['FILES']['MODEL_DIR'])
+    return index.query(model.cluster_centers_[cluster], k)
+
+
+@logged
+def benchmark_index(session: Session) -> dict:
+    """Recall of the stored index against exact search"""
+    index = SpeechIndex.load(config['FILES']['SPEECH_INDEX'])
+    vectorizer = load_vectorizer(config['FILES']['MODEL_DIR'])
+    texts = dict(get_all_speeches(session))
+    vectors = vectorizer.transform(texts[s] for s in index.speech_ids.tolist())
+    return benchmark(index, vectors)
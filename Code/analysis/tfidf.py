@@ -0,0 +1,75 @@
+"""Fitting of the tf-idf vectorizer in parallel: worker processes count the
+document and term frequencies of the n-grams in chunks of the speeches, the
+counts are merged and pruned (min_df, max_df, max_features) and turned into
+the vocabulary and idf weights exactly as `TfidfVectorizer.fit` does"""
+
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from numbers import Integral
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from helpers import logged
+
+
+def count_chunk(documents: list[str], params: dict) -> tuple[Counter, Counter]:
+    """Document and term frequencies of the n-grams of `documents` (run in a
+    separate process)"""
+    analyzer = TfidfVectorizer(**params).build_analyzer()
+    df, tf = Counter(), Counter()
+    for document in documents:
+        grams = analyzer(document)
+        tf.update(grams)
+        df.update(set(grams))
+    return df, tf
+
+
+def prune(dfs: np.ndarray, tfs: np.ndarray, n_docs: int, params: dict) -> np.ndarray:
+    """Mask of the (sorted) terms kept by min_df, max_df and max_features (as
+    `CountVectorizer._limit_features`)"""
+    max_df, min_df = params.get('max_df', 1.0), params.get('min_df', 1)
+    limit = params.get('max_features')
+    high = max_df if isinstance(max_df, Integral) else max_df * n_docs
+    low = min_df if isinstance(min_df, Integral) else min_df * n_docs
+    if high < low:
+        raise ValueError('max_df corresponds to < documents than min_df')
+    mask = (dfs <= high) & (dfs >= low)
+    if limit is not None and mask.sum() > limit:
+        # the same (unstable) sort as scikit-learn, ties are broken alike
+        kept = (-tfs[mask]).argsort()[:limit]
+        new_mask = np.zeros(len(dfs), dtype=bool)
+        new_mask[np.where(mask)[0][kept]] = True
+        mask = new_mask
+    if not mask.any():
+        raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+    return mask
+
+
+@logged
+def fit_parallel(documents: list[str], params: dict, workers: int | None = None,
+                 chunk_size: int = 5000) -> TfidfVectorizer:
+    """`TfidfVectorizer(**params).fit(documents)` with the counting split
+    across `workers` processes (None: one per CPU)"""
+    vectorizer = TfidfVectorizer(**params)
+    settings = vectorizer.get_params()
+    df, tf = Counter(), Counter()
+    chunks = [documents[i:i + chunk_size] for i in range(0, len(documents), chunk_size)]
+    # spawned rather than forked, as the parent runs threads (e.g. logging)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        for chunk_df, chunk_tf in pool.map(count_chunk, chunks, [params] * len(chunks)):
+            df.update(chunk_df)
+            tf.update(chunk_tf)
+    terms = sorted(df)
+    dfs = np.fromiter((df[t] for t in terms), dtype=np.int64, count=len(terms))
+    # scikit-learn sums the counts in the vectorizer's dtype
+    tfs = np.fromiter((tf[t] for t in terms), dtype=settings['dtype'], count=len(terms))
+    mask = prune(dfs, tfs, len(documents), settings)
+    vectorizer.vocabulary_ = {t: i for i, t in enumerate(np.array(terms, dtype=object)[mask])}
+    smooth = int(settings['smooth_idf'])
+    kept = dfs[mask].astype(np.float64) + smooth
+    vectorizer.idf_ = np.log((len(documents) + smooth) / kept) + 1.0
+    return vectorizer
@@ -0,0 +1,177 @@
+"""HTTP client shared by the download tasks. The number of requests in flight
+is limited per host and adapted to the server's responses (additive increase,
+multiplicative decrease); failed requests are retried with jittered
+exponential backoff"""
+
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import httpx
+
+from config import config
+
+
+# 429 (Too Many Requests) and server errors indicate congestion
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+logger = logging.getLogger(__name__)
+
+
+class HostLimiter:
+    """Adaptive limit on the number of concurrent requests to a single host"""
+
+    def __init__(self, host: str):
+        settings = config['CONCURRENCY']
+        self.host = host
+        self.limit = float(settings['INITIAL'])
+        self.min_limit = settings['MIN']
+        self.max_limit = config['MAX_CONCUR_REQ']
+        self.in_flight = 0
+        self.latency = 0.0  # moving average of successful requests
+        self.last_decrease = 0.0
+        self.counts = {'success': 0, 'congested': 0, 'retried': 0, 'failed': 0}
+        self.cond = threading.Condition()
+
+    def acquire(self) -> None:
+        """Wait until another request may be sent to the host"""
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float | None) -> None:
+        """Register the outcome of a request: `latency` is None if the
+        request signalled congestion (429, 5xx, timeout)"""
+        settings = config['CONCURRENCY']
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if latency is None or latency > settings['LATENCY_TARGET']:
+                self.counts['congested'] += 1
+                # decrease at most once per round trip, otherwise a burst of
+                # failures from the same window collapses the limit
+                if now - self.last_decrease > max(self.latency, 1.0):
+                    self.limit = max(self.min_limit,
+                                     self.limit * settings['DECREASE'])
+                    self.last_decrease = now
+            else:
+                self.counts['success'] += 1
+                self.latency = 0.8 * self.latency + 0.2 * latency
+                # roughly +1 per window of `limit` successful requests
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def count(self, outcome: str) -> None:
+        """Increase the counter of `outcome`"""
+        with self.cond:
+            self.counts[outcome] += 1
+
+    def metrics(self) -> dict:
+        """Current limit, requests in flight, mean latency and counters"""
+        with self.cond:
+            return {'limit': round(self.limit, 2), 'in_flight': self.in_flight,
+                    'latency': round(self.latency, 3), **self.counts}
+
+
+_limiters: dict[str, HostLimiter] = {}
+_lock = threading.Lock()
+_client: httpx.Client | None = None
+
+
+def get_limiter(host: str) -> HostLimiter:
+    """Obtain the (shared) limiter of `host`"""
+    with _lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(host)
+        return _limiters[host]
+
+
+def get_client() -> httpx.Client:
+    """Obtain the (shared, thread-safe) connection pool"""
+    global _client
+    with _lock:
+        if _client is None:
+            limits = httpx.Limits(max_connections=config['MAX_CONCUR_REQ'])
+            _client = httpx.Client(limits=limits)
+        return _client
+
+
+def backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    settings = config['CONCURRENCY']
+    cap = min(settings['BACKOFF_MAX'], settings['BACKOFF_BASE'] * 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+def retry_after(resp: httpx.Response) -> float | None:
+    """Delay requested by the server through the Retry-After header (in
+    seconds or as HTTP date)"""
+    value = resp.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Send a request within the limit of the host and retry on congestion;
+    raises the last error once all retries are exhausted"""
+    settings = config['CONCURRENCY']
+    kwargs.setdefault('timeout', settings['TIMEOUT'])
+    limiter = get_limiter(urlsplit(url).netloc)
+    for attempt in range(settings['RETRIES'] + 1):
+        limiter.acquire()
+        start = time.monotonic()
+        try:
+            resp = get_client().request(method, url, **kwargs)
+        except httpx.TransportError as err:
+            limiter.release(None)
+            error, delay = err, backoff(attempt)
+        else:
+            if resp.status_code not in RETRY_STATUS:
+                limiter.release(time.monotonic() - start)
+                resp.raise_for_status()
+                return resp
+            limiter.release(None)
+            error = httpx.HTTPStatusError(
+                f'{resp.status_code} for {url}', request=resp.request,
+                response=resp)
+            delay = retry_after(resp)
+            delay = backoff(attempt) if delay is None else min(
+                delay, settings['BACKOFF_MAX'])
+        if attempt < settings['RETRIES']:
+            limiter.count('retried')
+            logger.warning('Retry %s in %.1fs (%s)', url, delay, error)
+            time.sleep(delay)
+    limiter.count('failed')
+    raise error
+
+
+def get(url: str, **kwargs) -> httpx.Response:
+    """GET request, see `request`"""
+    return request('GET', url, **kwargs)
+
+
+def metrics() -> dict[str, dict]:
+    """Current limits and counters of all hosts"""
+    with _lock:
+        limiters = list(_limiters.values())
+    return {limiter.host: limiter.metrics() for limiter in limiters}
+
+
+def log_metrics() -> None:
+    """Write the current limits and counters to the log"""
+    for host, values in metrics().items():
+        logger.info('%s: %s', host, values)
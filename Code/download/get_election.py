@@ -1,33 +1,51 @@
 """Download of election data"""
 
 from lxml import etree
-import httpx
 from sqlalchemy.orm import Session
 
+from download import client
 from helpers import Task, logged
 from models import ElectionCandidate
 from config import config
 
 
-parser = etree.XMLPullParser(tag="ElectionCandidateForWeb")
+# candidates upserted at once
+BATCH_SIZE = 1000
+
+# bytes of the response fed to the parser at once
+CHUNK_SIZE = 1 << 16
 
 
 @logged
-def election_worker(item=None, session: Session) -> None:
+def election_worker(item=None, session: Session = None) -> None:
     """`worker` handles the entire download process"""
     # item is just there for compatibility
-    with httpx.stream("GET", config['DATA']['ELECTION_URL'], timeout=None) as stream:
-        for text in stream.iter_text():
-            parser.feed(text)
-            for event, element in parser.read_events():
-                election_date = element.find("ElectionDate").text
-                if election_date < config['TIME_RANGE']['T1'] and election_date > config['TIME_RANGE']['T0']:
-                    election_id = element.find("ElectionId").text
-                    # There is only one instance created!
-                    ec: ElectionCandidate = next(ElectionCandidate.create(
-                        element, election_id))
-                    ec.clean().save(session=session)
-        parser.close()
+    candidates = []
+    # limited, retried and timed out like the other requests; the response is
+    # read entirely so that a stalled transfer is retried from the start
+    content = client.get(config['DATA']['ELECTION_URL']).content
+    parser = etree.XMLPullParser(tag="ElectionCandidateForWeb")
+    for start in range(0, len(content), CHUNK_SIZE):
+        parser.feed(content[start:start + CHUNK_SIZE])
+        for event, element in parser.read_events():
+            election_date = element.find("ElectionDate").text
+            time_range = config['TIME_RANGE']
+            in_range = time_range['T0'] < election_date < time_range['T1']
+            if config['SUBSET']['ENABLED']:
+                # later elections are not needed; all candidates are kept
+                # as the close election dummy compares their votes
+                in_range = in_range and election_date[:10] <= config['SUBSET']['END']
+            if in_range:
+                election_id = element.find("ElectionId").text
+                # There is only one instance created!
+                ec: ElectionCandidate = next(ElectionCandidate.create(
+                    element, election_id))
+                candidates.append(ec.clean())
+                if len(candidates) >= BATCH_SIZE:
+                    ElectionCandidate.save_all(candidates, session=session)
+                    candidates = []
+    parser.close()
+    ElectionCandidate.save_all(candidates, session=session)
 
 
 ElectionTask = Task(lambda: [1], election_worker, ElectionCandidate)
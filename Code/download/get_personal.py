@@ -1,9 +1,15 @@
-"""Get personal information on members of parliament"""
+"""Get personal information on members of parliament, either one profile
+per identifier of `Link_ID.csv` or, in roster mode, from the roster of all
+members (one request) and only those profiles whose fields are missing in the
+roster"""
+
+import logging
+import threading
 
-import httpx
 from sqlalchemy.orm import Session
 
-from helpers import logged, Task
+from download import client
+from helpers import logged, Task, in_fraction
 from models import Personal, Experience, Election, Membership
 from config import config
 
@@ -13,11 +19,12 @@ tables = [Personal,  Election, Membership, Experience]
 @logged
 def get_ids() -> list:
     """get_ids() reads the list of IDs from file"""
-    # alternatively use the list provided by the following link
-    # https://lop.parl.ca/ParlinfoWebAPI/Person/SearchAndRefine?refiners=4-29%2C4-28%2C4-27%2C4-26%2C&_=1717999924321
+    # alternatively the roster mode uses the list provided by ROSTER_URL
     # => MoP in parliaments 17-20 (1930-09-08 to 1949-04-30)
     with open(config['FILES']['ID_FILE'], encoding="utf-8", mode="r") as file_obj:
         contents = [el.replace("\n", "") for el in file_obj.readlines()]
+    if config['SUBSET']['ENABLED']:
+        contents = [c for c in contents if in_fraction(c)]
     return contents
 
 
@@ -25,8 +32,7 @@ def get(identifier: str) -> dict:
     """get() requests the web profile from the API using the parliament
     identification key"""
     request_url = config['DATA']['PERSONAL_URL'] + identifier
-    resp = httpx.get(request_url, timeout=10)
-    resp.raise_for_status()
+    resp = client.get(request_url)
     return resp.json()
 
 
@@ -35,9 +41,74 @@ def personal_worker(item: str, session: Session) -> None:
     """Each worker executes the logic defined in the other modules. Each of
     them can be a separate thread"""
     profile = get(item)
+    save_profile(profile, item, session)
+
+
+def save_profile(profile: dict, identifier: str, session: Session) -> None:
+    """Store the records of all tables contained in `profile`"""
     for model in tables:
-        for instance in model.create(profile, item):
-            instance.clean().save(session=session)
+        instances = [i.clean() for i in model.create(profile, identifier)]
+        model.save_all(instances, session=session)
 
 
 PersonalTask = Task(get_ids, personal_worker, tables)
+
+
+# Roster mode -----------------------------------------------------------------
+
+# profiles requested and taken from the roster (see `report_requests`)
+_requests = {'profiles': 0, 'roster': 0}
+_lock = threading.Lock()
+
+
+@logged
+def get_roster() -> list[dict]:
+    """Summaries of all members of parliament (ROSTER_URL) in one request"""
+    roster = client.get(config['DATA']['ROSTER_URL']).json()
+    if config['SUBSET']['ENABLED']:
+        key = config['DATA']['KEYS']['PERS']['IDENTIFIER']
+        roster = [r for r in roster if in_fraction(str(r[key]))]
+    return roster
+
+
+def from_summary(summary: dict) -> dict:
+    """Profile (as returned by `get`) with the fields of a roster entry"""
+    profile = {'Person': summary}
+    for key in ['CommitteeMembership', 'FederalExperienceList', 'MilitaryExperience']:
+        if key in summary:
+            profile[key] = summary[key]
+    return profile
+
+
+def is_complete(profile: dict) -> bool:
+    """Check if the records of all tables can be read from `profile`"""
+    try:
+        for model in tables:
+            model.extract(profile, None)
+    except (KeyError, TypeError):
+        return False
+    return True
+
+
+@logged
+def roster_worker(item: dict, session: Session) -> None:
+    """Store a member of the roster, requesting the profile only if the
+    roster lacks some of its fields"""
+    identifier = str(item[config['DATA']['KEYS']['PERS']['IDENTIFIER']])
+    profile = from_summary(item)
+    complete = is_complete(profile)
+    if not complete:
+        profile = get(identifier)
+    with _lock:
+        _requests['roster' if complete else 'profiles'] += 1
+    save_profile(profile, identifier, session)
+
+
+def report_requests() -> None:
+    """Log how many profiles had to be requested"""
+    logging.getLogger('roster_worker').info(
+        'Requested %(profiles)d profiles, %(roster)d members were taken from the '
+        'roster', _requests)
+
+
+RosterTask = Task(get_roster, roster_worker, tables, report_requests)
@@ -1,8 +1,8 @@
 """Get date information for parliament session"""
 
-import httpx
 from sqlalchemy.orm import Session
 
+from download import client
 from models import ParliamentSession
 from helpers import Task, logged
 from config import config
@@ -14,18 +14,17 @@ from config import config
 def get_session_data(session: Session):
     """Download parliamentary sessions data from the library of the Canadian parliament"""
     # session argument is just for compatibility
-    data = httpx.get(config['DATA']['SESSION_URL']).json()
+    data = client.get(config['DATA']['SESSION_URL']).json()
     return data
 
 
 @logged
 def session_worker(s_list: list[dict], session: Session):
     """Obtain start and end dates of each session and save it as a ParliamentSession"""
-    # data in JSON format
-    for s in s_list:
-        # only one instance per iteration
-        el = next(ParliamentSession.create(s, ''))
-        el.handle_missing().clean().save(session=session)
+    # data in JSON format; sessions stored by an earlier run are updated
+    sessions = [next(ParliamentSession.create(s, '')).handle_missing().clean()
+                for s in s_list]
+    ParliamentSession.save_all(sessions, session=session)
 
 
 SessionTask = Task(get_session_data, session_worker, ParliamentSession)
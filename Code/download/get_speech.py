@@ -2,25 +2,30 @@
 
 from io import StringIO
 import csv
-from sqlite3 import IntegrityError
+import logging
+import re
+import threading
 
 from lxml import etree
-import httpx
-import sqlalchemy as sql
 from sqlalchemy.orm import Session
 
-from helpers import Task, logged
+import nlp
+from download import client
+from helpers import Task, KnownKeys, in_fraction, in_window, logged
 from models import Speech
 from config import config
 
 
 parser = etree.HTMLParser()
 
+_known: KnownKeys | None = None
+_lock = threading.Lock()
+
 
 @logged
 def get_speech_links() -> list:
     """Obtain links to all hainsards from the timeline"""
-    timeline = httpx.get(config['DATA']['SPEECH_URL'], timeout=30)
+    timeline = client.get(config['DATA']['SPEECH_URL'])
     tree = etree.fromstring(timeline.text, parser)
     decades_xpath = [
         '//*[@id="main"]/div[2]/div[1]/ul/li[4]/div[3]/ul',
@@ -33,32 +38,74 @@ def get_speech_links() -> list:
             for month in year[2]:
                 for day in month[2]:
                     links.append(day[0].get('href'))
+    if config['SUBSET']['ENABLED']:
+        links = [link for link in links if in_subset(link)]
     return links
 
 
+def link_day(link: str) -> str | None:
+    """ISO date of the day of `link` (.../YYYY/MM/DD/)"""
+    day = re.search(r'(\d{4})/(\d{2})/(\d{2})', link)
+    return '-'.join(day.groups()) if day else None
+
+
+def in_subset(link: str) -> bool:
+    """Check if the day of `link` is part of the subset"""
+    day = link_day(link)
+    return day is not None and in_window(day) and in_fraction(link)
+
+
+def get_known(session: Session) -> KnownKeys:
+    """Obtain the ids of the stored speeches (loaded by the first worker)"""
+    global _known
+    with _lock:
+        if _known is None:
+            _known = KnownKeys(Speech.speech_id, session)
+        return _known
+
+
+def reset_known() -> None:
+    """Forget the ids of the stored speeches, e.g. to write to another shard"""
+    global _known
+    with _lock:
+        _known = None
+
+
 @logged
 def speech_worker(item: str, session: Session) -> None:
     """`worker` downloads speech data given the (sub)paths"""
-    resp = httpx.get(config['DATA']['SPEECH_URL'] + item + "exportcsv/")
-    resp.raise_for_status()
+    resp = client.get(config['DATA']['SPEECH_URL'] + item + "exportcsv/")
     # The following might be unnecessary as httpx logs for itself
     speech_data = resp.text
     stream = StringIO(speech_data)
     # csv header is not relevant to us
     stream.readline()
-    reader = csv.reader(stream)
-    for row in reader:
-        try:
-            # only one instance per iteration
-            next(Speech.create(row, item)).handle_missing(
-                row).clean().save(session=session)
-        except sql.exc.IntegrityError:
-            session.rollback()
-            continue
-        except IntegrityError:
-            session.rollback()
-            continue
+    rows = list(csv.reader(stream))
     stream.close()
+    # speeches stored by an earlier run are dropped before the costly cleaning
+    ids = [int(row[Speech.keys['SPEECH_ID']]) for row in rows]
+    known = get_known(session)
+    stored = known.known(ids, session)
+    speeches = []
+    for speech_id, row in zip(ids, rows):
+        if speech_id in stored:
+            continue
+        # only one instance per iteration
+        speeches.append(next(Speech.create(row, item)).handle_missing(row))
+    # the texts of the day are tokenized in one batch (one request to the NLP
+    # service if it is used), cleaning then takes the tokens from the cache
+    nlp.analyse_many([speech.speech_text for speech in speeches if speech.speech_text])
+    speeches = [speech.clean() for speech in speeches]
+    # stored at once; speeches stored in the meantime are skipped on insertion
+    known.add(Speech.save_all(speeches, session))
+
+
+def report_skipped() -> None:
+    """Log how many speeches were skipped as already stored"""
+    if _known is not None:
+        logging.getLogger('speech_worker').info(
+            'Skipped %(skipped)d of %(checked)d speeches as already stored '
+            '(%(false_positive)d false positives of the filter)', _known.counts)
 
 
-SpeechTask = Task(get_speech_links, speech_worker, Speech)
+SpeechTask = Task(get_speech_links, speech_worker, Speech, report_skipped)
@@ -0,0 +1,171 @@
+"""Local stand-in for the Parlinfo person endpoints (roster and web profiles)
+for testing the download without the real server, e.g.
+
+    python -m download.stand_in --members 50 --complete 0.5 --throttle 0.1
+
+(from the directory `Code`) and pointing DATA.ROSTER_URL and PERSONAL_URL to
+the printed addresses. Responses are synthetic, built from the key paths of
+the config, or recorded ones (`--data`: roster.json and profiles/<id>.json)"""
+
+import argparse
+import json
+import os
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import config
+
+
+ROSTER_PATH = '/ParlinfoWebAPI/Person/SearchAndRefine'
+PROFILE_PATH = '/ParlinfoWebApi/Person/GetPersonWebProfile/'
+
+# lists of a profile which the roster only has for complete members
+LISTS = ['CommitteeMembership', 'FederalExperienceList', 'MilitaryExperience']
+
+
+def fake_value(path: str, identifier: int, i: int):
+    """Plausible value of the field `path` of the `i`-th record"""
+    if 'Date' in path:
+        return f'{1930 + i}-01-01T00:00:00'
+    if 'Number' in path:
+        return 17 + i
+    if path == 'IsGeneral':
+        return True
+    if path == 'Votes':
+        return str(1000 + identifier + i)
+    return f'{path} {identifier}'
+
+
+def fake_records(keys: dict, identifier: int, n: int) -> list[dict]:
+    """`n` records with the key paths `keys`"""
+    return [{path: fake_value(path, identifier, i) for path in keys.values() if path}
+            for i in range(n)]
+
+
+def fake_profile(identifier: int) -> dict:
+    """Web profile of a member of parliament (see `get_personal.get`)"""
+    keys = config['DATA']['KEYS']
+    person = fake_records(keys['PERS'], identifier, 1)[0]
+    person[keys['PERS']['IDENTIFIER']] = identifier
+    person['ElectionCandidates'] = fake_records(keys['ELEC'], identifier, 2)
+    return {'Person': person,
+            'CommitteeMembership': fake_records(keys['MEMB'], identifier, 3),
+            'FederalExperienceList': fake_records(keys['EXP'], identifier, 1),
+            'MilitaryExperience': None if identifier % 3 else {'Branch': 'Army'}}
+
+
+def summary(profile: dict, complete: bool) -> dict:
+    """Roster entry of `profile`, with its lists if `complete`"""
+    entry = {k: v for k, v in profile['Person'].items() if k != 'ElectionCandidates'}
+    if complete:
+        entry['ElectionCandidates'] = profile['Person']['ElectionCandidates']
+        entry |= {key: profile[key] for key in LISTS}
+    return entry
+
+
+class StandIn(ThreadingHTTPServer):
+    """Server of the roster and `profiles` (by identifier)"""
+
+    def __init__(self, port: int, roster: list[dict], profiles: dict[str, dict],
+                 throttle: float = 0.0):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.roster = roster
+        self.profiles = profiles
+        self.throttle = throttle  # share of requests answered with 429
+        self.counts = {'roster': 0, 'profile': 0, 'throttled': 0}
+        self.lock = threading.Lock()
+
+    def urls(self) -> dict[str, str]:
+        """Config values (DATA) which point to the stand-in"""
+        base = f'http://127.0.0.1:{self.server_address[1]}'
+        return {'ROSTER_URL': base + ROSTER_PATH, 'PERSONAL_URL': base + PROFILE_PATH}
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.counts[key] += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server: StandIn = self.server
+        if random.random() < server.throttle:
+            server.count('throttled')
+            self.send_response(429)
+            self.send_header('Retry-After', '0.1')
+            self.end_headers()
+            return
+        path = self.path.split('?')[0]
+        if path == ROSTER_PATH:
+            server.count('roster')
+            self.send_json(server.roster)
+        elif path.startswith(PROFILE_PATH) and path[len(PROFILE_PATH):] in server.profiles:
+            server.count('profile')
+            self.send_json(server.profiles[path[len(PROFILE_PATH):]])
+        else:
+            self.send_error(404)
+
+    def send_json(self, data) -> None:
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def synthetic(members: int, complete: float, seed: int = 1) -> tuple[list[dict], dict[str, dict]]:
+    """Roster and profiles of `members` fake members, the share `complete` of
+    which have all fields in the roster"""
+    rng = random.Random(seed)
+    profiles = {str(i): fake_profile(i) for i in range(1, members + 1)}
+    roster = [summary(p, rng.random() < complete) for p in profiles.values()]
+    return roster, profiles
+
+
+def recorded(directory: str) -> tuple[list[dict], dict[str, dict]]:
+    """Roster and profiles stored in `directory`"""
+    with open(os.path.join(directory, 'roster.json'), encoding='utf-8') as file:
+        roster = json.load(file)
+    profiles = {}
+    for name in os.listdir(os.path.join(directory, 'profiles')):
+        with open(os.path.join(directory, 'profiles', name), encoding='utf-8') as file:
+            profiles[name.removesuffix('.json')] = json.load(file)
+    return roster, profiles
+
+
+def serve(port: int = 0, members: int = 20, complete: float = 0.5,
+          throttle: float = 0.0, data: str | None = None) -> StandIn:
+    """Start a stand-in in a background thread (port 0: any free port)"""
+    roster, profiles = recorded(data) if data else synthetic(members, complete)
+    server = StandIn(port, roster, profiles, throttle)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--members', type=int, default=20)
+    parser.add_argument('--complete', type=float, default=0.5,
+                        help='share of members with all fields in the roster')
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='share of requests answered with 429')
+    parser.add_argument('--data', help='directory with recorded responses')
+    args = parser.parse_args()
+    server = serve(args.port, args.members, args.complete, args.throttle, args.data)
+    for key, url in server.urls().items():
+        print(f'{key}: {url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""Durable work queue of the download Tasks in the table `job_queue`: the items
+of the Tasks are enqueued once (`python code enqueue`) and claimed by any number
+of worker processes (`python code work`), also on several hosts which share the
+database file. A worker leases a batch of jobs of one Task and renews the lease
+by a heartbeat while working on it; the jobs of a crashed worker are claimed
+again once its lease expired. Failed jobs are retried up to QUEUE.MAX_ATTEMPTS
+times and are dead afterwards (see `retry_dead`)"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as sql
+import sqlalchemy.orm as orm
+from sqlalchemy.dialects.sqlite import insert
+
+import shards
+from download import client
+from helpers import Task, logged, work_parallel
+from models import Job
+from config import config
+
+
+# rows inserted at once
+CHUNK_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+def get_tasks() -> dict[str, Task]:
+    """Download Tasks by their name in the queue"""
+    from download.get_personal import PersonalTask, RosterTask
+    from download.get_election import ElectionTask
+    from download.get_speech import SpeechTask
+    personal = RosterTask if config['ROSTER']['ENABLED'] else PersonalTask
+    return {'personal': personal, 'election': ElectionTask, 'speech': SpeechTask}
+
+
+def job_shard(name: str, item) -> int | None:
+    """First year of the shard a speech item is stored in (None if not sharded)"""
+    if name != 'speech' or not shards.enabled():
+        return None
+    from download.get_speech import link_day
+    return shards.shard_of(link_day(item))
+
+
+def queue_session(Session: orm.Session) -> orm.Session:
+    """Short-lived session of the queue, separate from the (thread-local)
+    sessions of the workers"""
+    return orm.Session(Session.get_bind())
+
+
+@logged
+def enqueue(Session: orm.Session, names: list[str]) -> int:
+    """Add the items of the Tasks `names` which are not queued yet and return
+    the number of new jobs"""
+    tasks = get_tasks()
+    with queue_session(Session) as session:
+        before = session.scalar(sql.select(sql.func.count()).select_from(Job))
+        for name in names:
+            now = datetime.now()
+            rows = [{'task': name, 'item': json.dumps(item, sort_keys=True),
+                     'shard': job_shard(name, item), 'available': now, 'updated': now}
+                    for item in tasks[name].setup()]
+            for start in range(0, len(rows), CHUNK_SIZE):
+                session.execute(insert(Job).on_conflict_do_nothing(
+                    index_elements=['task', 'item']), rows[start:start + CHUNK_SIZE])
+            session.commit()
+        return session.scalar(sql.select(sql.func.count()).select_from(Job)) - before
+
+
+def retry_dead(Session: orm.Session, names: list[str]) -> int:
+    """Make the dead jobs of `names` pending again and return their number"""
+    with queue_session(Session) as session:
+        result = session.execute(sql.update(Job).where(
+            Job.state == 'dead', Job.task.in_(names)).values(
+            state='pending', attempts=0, available=datetime.now(), updated=datetime.now()))
+        session.commit()
+        return result.rowcount
+
+
+def status(Session: orm.Session) -> dict[str, dict[str, int]]:
+    """Number of jobs per Task and state"""
+    counts = {}
+    with queue_session(Session) as session:
+        for name, state, n in session.execute(sql.select(
+                Job.task, Job.state, sql.func.count()).group_by(Job.task, Job.state)):
+            counts.setdefault(name, {})[state] = n
+    return counts
+
+
+# Leases ----------------------------------------------------------------------
+
+
+def claim(session: orm.Session, worker: str, names: list[str]) -> list[sql.Row]:
+    """Lease up to QUEUE.BATCH claimable jobs (pending, or with an expired
+    lease) of a single Task and shard to `worker`"""
+    settings = config['QUEUE']
+    now = datetime.now()
+    # the first statement takes the write lock, which serializes the claims of
+    # all workers; expired jobs without attempts left are dead
+    session.execute(sql.update(Job).where(
+        Job.state == 'leased', Job.lease_expires < now,
+        Job.attempts >= settings['MAX_ATTEMPTS']).values(
+        state='dead', error=sql.func.coalesce(Job.error, 'lease expired'), updated=now))
+    claimable = sql.and_(Job.task.in_(names), sql.or_(
+        sql.and_(Job.state == 'pending', Job.available <= now),
+        sql.and_(Job.state == 'leased', Job.lease_expires < now)))
+    first = session.execute(sql.select(Job.task, Job.shard).where(claimable).order_by(
+        Job.job_id).limit(1)).first()
+    if first is None:
+        session.commit()
+        return []
+    ids = sql.select(Job.job_id).where(
+        claimable, Job.task == first.task, Job.shard.is_not_distinct_from(first.shard)).order_by(
+        Job.job_id).limit(settings['BATCH']).scalar_subquery()
+    jobs = session.execute(sql.update(Job).where(Job.job_id.in_(ids)).values(
+        state='leased', worker=worker, attempts=Job.attempts + 1,
+        lease_expires=now + timedelta(seconds=settings['LEASE']), updated=now).returning(
+        Job.job_id, Job.task, Job.item, Job.shard, Job.attempts)).all()
+    session.commit()
+    return sorted(jobs, key=lambda job: job.job_id)
+
+
+def renew(Session: orm.Session, worker: str) -> int:
+    """Extend the leases of `worker` and return their number"""
+    now = datetime.now()
+    with queue_session(Session) as session:
+        result = session.execute(sql.update(Job).where(
+            Job.state == 'leased', Job.worker == worker).values(
+            lease_expires=now + timedelta(seconds=config['QUEUE']['LEASE']), updated=now))
+        session.commit()
+        return result.rowcount
+
+
+def heartbeat(Session: orm.Session, worker: str, stop: threading.Event) -> None:
+    """Renew the leases of `worker` every QUEUE.HEARTBEAT seconds until `stop`
+    is set (run in a thread)"""
+    while not stop.wait(config['QUEUE']['HEARTBEAT']):
+        try:
+            renew(Session, worker)
+        except sql.exc.OperationalError as err:
+            # e.g. locked; the lease lasts several heartbeats
+            logger.warning('Heartbeat of %s failed: %s', worker, err)
+
+
+def finish(Session: orm.Session, job: sql.Row, error: Exception | None = None) -> None:
+    """Mark `job` as done or, if it failed, as pending again after
+    QUEUE.RETRY_DELAY seconds (dead without attempts left)"""
+    settings = config['QUEUE']
+    now = datetime.now()
+    if error is None:
+        values = {'state': 'done', 'error': None}
+    else:
+        dead = job.attempts >= settings['MAX_ATTEMPTS']
+        values = {'state': 'dead' if dead else 'pending', 'error': repr(error),
+                  'available': now + timedelta(seconds=settings['RETRY_DELAY'])}
+    with queue_session(Session) as session:
+        session.execute(sql.update(Job).where(Job.job_id == job.job_id).values(
+            worker=None, lease_expires=None, updated=now, **values))
+        session.commit()
+
+
+def is_waiting(Session: orm.Session, names: list[str]) -> bool:
+    """Check if jobs of `names` are pending or leased (and may fail)"""
+    with queue_session(Session) as session:
+        return session.scalar(sql.select(sql.exists().where(
+            Job.task.in_(names), Job.state.in_(['pending', 'leased']))))
+
+
+# Workers ---------------------------------------------------------------------
+
+
+def job_worker(task: Task, Session: orm.Session):
+    """Worker (see `work_parallel`) which runs `task` on the item of a job and
+    records the outcome in the queue"""
+    def worker(job: sql.Row, session: orm.Session) -> None:
+        try:
+            task.run(json.loads(job.item), session=session)
+        except Exception as err:
+            finish(Session, job, err)
+            raise
+        finish(Session, job)
+    return worker
+
+
+@logged
+def work(Session: orm.Session, names: list[str], worker: str | None = None) -> None:
+    """Claim and run jobs of the Tasks `names` until none is pending or leased"""
+    from download import get_speech
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    tasks = get_tasks()
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(Session, worker, stop), daemon=True).start()
+    ran, sessions, speech_shard = set(), {}, None
+    try:
+        while True:
+            with queue_session(Session) as session:
+                jobs = claim(session, worker, names)
+            if not jobs:
+                if not is_waiting(Session, names):
+                    break
+                time.sleep(config['QUEUE']['POLL'])
+                continue
+            name, shard = jobs[0].task, jobs[0].shard
+            session = Session
+            if shard is not None:
+                # the views of the main database cannot be written to
+                if shard not in sessions:
+                    sessions[shard] = orm.scoped_session(
+                        orm.sessionmaker(bind=shards.create_shard(shard)))
+                session = sessions[shard]
+            if name == 'speech' and shard != speech_shard:
+                # the stored speeches are those of the shard
+                get_speech.reset_known()
+                speech_shard = shard
+            work_parallel(job_worker(tasks[name], Session), session, jobs)
+            ran.add(name)
+    finally:
+        stop.set()
+    for name in ran:
+        if tasks[name].report:
+            tasks[name].report()
+    client.log_metrics()
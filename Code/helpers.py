@@ -1,15 +1,27 @@
 """Useful helper functions and a Task tuple"""
 
+import atexit
+import hashlib
+import json
 import logging
+import math
+import queue
 import re
+import threading
+import time
 from collections import namedtuple
-from collections.abc import Callable
-from datetime import date
-from typing import Generator
+from collections.abc import Callable, Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timezone
+from functools import cache, partial, wraps
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Generator
 
 
+import numpy as np
 import sqlalchemy as sql
 import sqlalchemy.orm as orm
+from sqlalchemy.dialects.sqlite import insert
 
 from config import config
 
@@ -17,21 +29,97 @@ from config import config
 # Logging ---------------------------------------------------------------------
 
 
+TEXT_FORMAT = "%(levelname)s %(asctime)s %(name)s %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                 'level': record.levelname, 'logger': record.name,
+                 'thread': record.threadName, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def setup_logging(path: str) -> None:
+    """setup_logging() routes all records through a queue to a listener
+    thread which writes them to `path`, so that the workers do not wait for
+    the file"""
+    handler = logging.FileHandler(path, mode='w', encoding='utf-8')
+    if config['LOGGING']['FORMAT'] == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers = [QueueHandler(records)]
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # writes the remaining records
+
+
+class CallStats:
+    """Number of calls, failures and total duration of a function"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls, self.failed, self.duration = 0, 0, 0.0
+
+    def start(self) -> int:
+        with self.lock:
+            self.calls += 1
+            return self.calls
+
+    def finish(self, duration: float, failed: bool) -> tuple[int, int, float]:
+        with self.lock:
+            self.failed += failed
+            self.duration += duration
+            return self.calls, self.failed, self.duration / self.calls
+
+
 def logged(func: Callable) -> Callable:
-    """logged() adds separate Debugger to decorated functions"""
+    """logged() adds separate Debugger to decorated functions. Functions
+    called per item (e.g. workers) would flood the log, which is why only the
+    first LOGGING.SAMPLE_FIRST calls and every SAMPLE_EVERY-th call after
+    that are logged, the latter with the aggregate counts"""
+    logger = logging.getLogger(func.__qualname__)
+    stats = CallStats()
+
+    @wraps(func)
     def foo(*args, **kwargs):
         id = args[0] if len(args) > 0 else ''
-        func.logger = logging.getLogger(func.__qualname__)
-        func.logger.info('Started %s', id)
-        result = func(*args, **kwargs)
-        func.logger.info('Finished %s', id)
+        n = stats.start()
+        first = n <= config['LOGGING']['SAMPLE_FIRST']
+        sampled = first or n % config['LOGGING']['SAMPLE_EVERY'] == 0
+        if sampled:
+            logger.info('Started %s', id)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            stats.finish(time.perf_counter() - start, failed=True)
+            raise
+        calls, failed, mean = stats.finish(time.perf_counter() - start, failed=False)
+        if first:
+            logger.info('Finished %s', id)
+        elif sampled:
+            logger.info('Finished %s (%d calls, %d failed, %.3fs on average)',
+                        id, calls, failed, mean)
         return result
     return foo
 
 
 # Setup -----------------------------------------------------------------------
 
-Task = namedtuple("Task", ["setup", "run", "models"])
+# `report` (optional) logs a summary once the task has run; `config` (dotted
+# keys, e.g. 'SPEECH_CRITERIA.CLUSTERS') and `inputs` (models) declare what the
+# task reads, which lets an unchanged task be skipped (see `stages`)
+Task = namedtuple("Task", ["setup", "run", "models", "report", "config", "inputs"],
+                  defaults=[None, None, None])
 
 
 def sql_get(stmt: sql.Select, session: orm.Session):
@@ -39,6 +127,23 @@ def sql_get(stmt: sql.Select, session: orm.Session):
     return session.execute(stmt).all()
 
 
+@logged
+def work_parallel(worker: Callable, session: orm.Session, items: Iterable) -> list:
+    """work_parallel() creates up to n threads which fetch the profiles and
+    handle the obtained data; the number of concurrent requests is adapted by
+    `download.client`. It returns the items that failed"""
+    failed = []
+    with ThreadPoolExecutor(max_workers=config['MAX_CONCUR_REQ']) as pool:
+        worker = partial(worker, session=session)
+        futures = {pool.submit(worker, item): item for item in items}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                logging.error('Failed %s: %r', futures[future],
+                              future.exception())
+                failed.append(futures[future])
+    return failed
+
+
 # ORM Base Class --------------------------------------------------------------
 
 class Base(orm.DeclarativeBase):
@@ -46,31 +151,41 @@ class Base(orm.DeclarativeBase):
 
     keys: dict[str, str | int] = {}
     identifier: int = -1
+    # column which is filled with the identifier passed to `extract` (e.g. the
+    # person a committee membership belongs to)
+    owner: str | None = None
+    # columns or expressions of the unique index which identifies a row across
+    # downloads (see `models.natural_key`; default: the primary key)
+    natural_key: tuple = ()
 
     def __repr__(self):
         pass
 
     @staticmethod
-    def get_info(key, data):
+    def records(data) -> Sequence:
+        """`records` returns the entries of the response which correspond to
+        one table instance each"""
+        return [data]
+
+    @staticmethod
+    def get_info(key, record):
         """`get_info` extracts information from single data entry"""
+        return record[key]
+
+    @classmethod
+    def extract(cls, data, identifier: Any) -> dict[str, list]:
+        """`extract` reads the information from the response using the key
+        paths provided by the keys attribute and returns it as columns (dict
+        of lists). It does not keep any state, so it is safe to call from
+        any number of threads or processes"""
+        return compile_extractor(cls)(data, identifier)
 
     @classmethod
-    def create(cls, data: dict, request: str) -> Generator["Base", None, None]:
-        """`create` reads the information from the response using the key paths
-        provided by the paths attribute and creates table instances"""
-        # The following line is used for debugging but also to introduce the
-        # identifier for Experience, Membership and Election!
-        cls.request = request
-        iterators = {}
-        iterators = {field.lower(): cls.get_info(cls.keys[field], data)
-                     for field in cls.keys}
-        while True:
-            try:
-                entries = {field: next(iterators[field])
-                           for field in iterators}
-                yield cls(**entries)
-            except StopIteration:
-                break
+    def create(cls, data, identifier: Any) -> Generator["Base", None, None]:
+        """`create` creates table instances from the extracted columns"""
+        columns = cls.extract(data, identifier)
+        for values in zip(*columns.values()):
+            yield cls(**dict(zip(columns, values)))
 
     def clean(self):
         """`clean` and reformat the received data"""
@@ -83,15 +198,163 @@ class Base(orm.DeclarativeBase):
             session.commit()
         # OperationalError is more specific than DBAPIError
         except sql.exc.OperationalError as err:
-            Base.save.logger.error(
+            logging.getLogger('Base.save').error(
                 f"Problem ({err}): {self.__tablename__}, {self.identifier}"
             )
         except sql.exc.DBAPIError as err:
-            Base.save.logger.error(
+            logging.getLogger('Base.save').error(
                 f"Problem ({err}): {self.__tablename__}, {self.identifier}"
             )
             session.rollback()
 
+    @classmethod
+    def rows(cls, instances: list["Base"]) -> list[dict]:
+        """Column values of `instances` (a missing integer primary key is
+        generated by SQLite)"""
+        names = [c.key for c in cls.__table__.columns]
+        return [{name: getattr(i, name) for name in names} for i in instances]
+
+    @classmethod
+    def save_all(cls, instances: list["Base"], session: orm.Session) -> None:
+        """`save_all` upserts a batch of instances in a single statement: an
+        instance with the natural key of a stored row updates it, so that
+        downloading data again does not duplicate rows. If rows were inserted
+        or changed, the version of the table is increased, as its row count
+        and largest key (see `stages.table_state`) may stay the same"""
+        if not instances:
+            return
+        table = cls.__table__
+        stmt = insert(table)
+        key = cls.natural_key or list(table.primary_key.columns)
+        columns = [c for c in table.columns if not c.primary_key]
+        # stored rows which are equal are not counted as changed
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key, set_={c.key: stmt.excluded[c.key] for c in columns},
+            where=sql.or_(*[c.is_distinct_from(stmt.excluded[c.key]) for c in columns]))
+        try:
+            result = session.execute(stmt, cls.rows(instances))
+            if result.rowcount:
+                versions = Base.metadata.tables['table_version']
+                bump = insert(versions).values(name=table.name, version=1)
+                session.execute(bump.on_conflict_do_update(
+                    index_elements=['name'], set_={'version': versions.c.version + 1}))
+            session.commit()
+        except sql.exc.DBAPIError as err:
+            logging.getLogger('Base.save_all').error(
+                f"Problem ({err}): {[(i.__tablename__, i.identifier) for i in instances]}"
+            )
+            session.rollback()
+
+
+@cache
+def compile_extractor(model: type[Base]) -> Callable[[Any, Any], dict[str, list]]:
+    """Compile the key paths of `model` once into a function which turns a
+    response into a column batch"""
+    getters = [(field.lower(), partial(model.get_info, key))
+               for field, key in model.keys.items()]
+    records, owner = model.records, model.owner
+
+    def extractor(data, identifier) -> dict[str, list]:
+        rows = records(data)
+        columns = {name: [get(r) for r in rows] for name, get in getters}
+        if owner:
+            columns[owner] = [identifier] * len(rows)
+        return columns
+    return extractor
+
+
+# Subset ----------------------------------------------------------------------
+
+def in_fraction(key: Any) -> bool:
+    """Deterministic selection of the share SUBSET.FRACTION of all keys (the
+    same keys in every run)"""
+    digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') < config['SUBSET']['FRACTION'] * 2 ** 64
+
+
+def in_window(day: str) -> bool:
+    """Check if the ISO date `day` lies between SUBSET.START and SUBSET.END"""
+    return config['SUBSET']['START'] <= day[:10] <= config['SUBSET']['END']
+
+
+# Ingest ----------------------------------------------------------------------
+
+class KnownKeys:
+    """Integer keys already stored in a table, loaded once so that known rows
+    can be dropped before any expensive processing. Up to INGEST.EXACT_LIMIT
+    keys are held in a set, beyond that in a Bloom filter whose positives are
+    confirmed by a query"""
+
+    # rows read from the table at once
+    CHUNK_SIZE = 100000
+
+    def __init__(self, column: orm.InstrumentedAttribute, session: orm.Session):
+        settings = config['INGEST']
+        self.column = column
+        self.lock = threading.Lock()
+        self.counts = {'checked': 0, 'skipped': 0, 'false_positive': 0}
+        n = session.scalar(sql.select(sql.func.count()).select_from(column.table))
+        self.keys: set[int] | None = None
+        self.bits: np.ndarray | None = None
+        if n <= settings['EXACT_LIMIT']:
+            self.keys = set(session.scalars(sql.select(column)))
+            return
+        # room for the table to double during the run
+        p = settings['FALSE_POSITIVE_RATE']
+        self.size = math.ceil(-2 * n * math.log(p) / math.log(2) ** 2)
+        self.hashes = max(1, round(-math.log(p) / math.log(2)))
+        self.bits = np.zeros(self.size, dtype=bool)
+        result = session.execute(sql.select(column).execution_options(
+            yield_per=self.CHUNK_SIZE))
+        for chunk in result.partitions():
+            self.bits[self.positions([r[0] for r in chunk])] = True
+
+    def positions(self, keys: list[int]) -> np.ndarray:
+        """Bit positions of `keys` (keys x hashes), double hashing of a
+        64-bit mix of the key"""
+        x = np.array(keys, dtype=np.int64).view(np.uint64)
+        h1 = mix(x)
+        h2 = mix(x ^ np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+        i = np.arange(self.hashes, dtype=np.uint64)
+        return ((h1[:, None] + i * h2[:, None]) % np.uint64(self.size)).astype(np.int64)
+
+    def known(self, keys: list[int], session: orm.Session) -> set[int]:
+        """Those `keys` which are stored in the table"""
+        if self.keys is not None:
+            with self.lock:
+                found = self.keys.intersection(keys)
+        elif keys:
+            with self.lock:
+                maybe = self.bits[self.positions(keys)].all(axis=1)
+            candidates = [k for k, m in zip(keys, maybe) if m]
+            found = set(session.scalars(sql.select(self.column).where(
+                self.column.in_(candidates)))) if candidates else set()
+            session.commit()  # ends the read transaction
+            with self.lock:
+                self.counts['false_positive'] += len(candidates) - len(found)
+        else:
+            found = set()
+        with self.lock:
+            self.counts['checked'] += len(keys)
+            self.counts['skipped'] += len(found)
+        return found
+
+    def add(self, keys: list[int]) -> None:
+        """Register newly stored `keys`"""
+        with self.lock:
+            if self.keys is not None:
+                self.keys.update(keys)
+            elif keys:
+                self.bits[self.positions(keys)] = True
+
+
+def mix(x: np.ndarray) -> np.ndarray:
+    """Finalizer of SplitMix64 (uint64 array)"""
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
 
 # Cleaning --------------------------------------------------------------------
 
@@ -3,14 +3,16 @@
 """Database models"""
 
 
-from datetime import date
+import logging
+from datetime import date, datetime
 
-from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.dialects.sqlite import insert
 import sqlalchemy as sql
-import spacy
 
 
-from helpers import clean_name, create_date, Base, logged
+from helpers import clean_name, create_date, Base
+from nlp import analyse, filter_tokens, encode_tokens, compress_text, lemma_id
 from config import config
 
 
@@ -32,16 +34,10 @@ class Personal(Base):
         return f"Personal(identifier = {self.identifier!r},  ...)"
 
     @staticmethod
-    def get_info(key, data):
+    def get_info(key, record):
         if key == '':
-            info = data['MilitaryExperience']
-            if info is None:
-                yield False
-            else:
-                yield True
-        else:
-            info = data['Person'][key]
-            yield info
+            return record['MilitaryExperience'] is not None
+        return record['Person'][key]
 
     def clean(self):
         self.birth_day = create_date(self.birth_day)
@@ -56,6 +52,7 @@ class Membership(Base):
     __tablename__ = "committee_membership"
 
     keys = config['DATA']['KEYS']["MEMB"]
+    owner = 'identifier'
 
     membership_id: Mapped[int] = mapped_column(
         sql.Integer, primary_key=True, autoincrement=True
@@ -75,14 +72,8 @@ class Membership(Base):
         return f"Membership(membership_id = {self.membership_id!r}, ...)"
 
     @staticmethod
-    def get_info(key, data):
-        for el in data['CommitteeMembership']:
-            yield el[key]
-
-    def clean(self):
-        # We abuse this method to introduce the identifier for each instance
-        self.identifier = self.request
-        return self
+    def records(data):
+        return data['CommitteeMembership']
 
 
 class Election(Base):
@@ -91,6 +82,7 @@ class Election(Base):
     __tablename__ = "election_results"
 
     keys = config['DATA']['KEYS']["ELEC"]
+    owner = 'identifier'
 
     election_id: Mapped[int] = mapped_column(
         sql.Integer, primary_key=True, autoincrement=True
@@ -110,13 +102,10 @@ class Election(Base):
         return f"Election(election_id = {self.election_id!r}, ...)"
 
     @staticmethod
-    def get_info(key, data):
-        for el in data['Person']['ElectionCandidates']:
-            yield el[key]
+    def records(data):
+        return data['Person']['ElectionCandidates']
 
     def clean(self):
-        # We abuse this method to introduce the identifier for each instance
-        self.identifier = self.request
         self.election_date = create_date(
             self.election_date) if self.election_date else create_date("2050-01-01")
         return self
@@ -127,6 +116,7 @@ class Experience(Base):
 
     __tablename__ = "federal_experience"
     keys = config['DATA']['KEYS']["EXP"]
+    owner = 'identifier'
 
     experience_id: Mapped[int] = mapped_column(
         sql.Integer, primary_key=True, autoincrement=True
@@ -145,13 +135,10 @@ class Experience(Base):
         return f"Experience(experience_id: {self.experience_id!r},  ...)"
 
     @staticmethod
-    def get_info(key, data):
-        for el in data['FederalExperienceList']:
-            yield el[key]
+    def records(data):
+        return data['FederalExperienceList']
 
     def clean(self):
-        # We abuse this method to introduce the identifier for each instance
-        self.identifier = self.request
         for attr, path in self.keys.items():
             info = getattr(self, attr.lower())
             if "Date" in path:
@@ -168,34 +155,32 @@ class Speech(Base):
 
     __tablename__ = "speech"
     keys = config['DATA']['KEYS']["SPEECH"]
-    nlp = spacy.load('en_core_web_sm')
 
     speech_id: Mapped[int] = mapped_column(sql.Integer, primary_key=True)
     speech_date: Mapped[date] = mapped_column(sql.Date)
     topic: Mapped[str] = mapped_column(sql.String, nullable=True)
     speech_text: Mapped[str] = mapped_column(sql.Text)
     speaker_party: Mapped[str] = mapped_column(sql.String, nullable=True)
-    speaker_name: Mapped[str] = mapped_column(sql.String)
+    speaker_id: Mapped[int] = mapped_column(
+        sql.BigInteger, sql.ForeignKey('speaker.speaker_id'))
+    tokens: Mapped["SpeechTokens"] = relationship()
+    # cleaned name of the speaker as extracted, stored in `Speaker`
+    speaker_name = None
 
     def __repr__(self):
         return f"Speech(speech_id: {self.speech_id!r}, ...)"
 
-    @staticmethod
-    def get_info(key, data):
-        yield data[key]
-
-    @logged
     def handle_missing(self, data):
         """`handle_missing` is an attempt to repair missing values or fail fast"""
         if not self.speaker_name:
-            speakeroldname = next(Speech.get_info(5, data))  # speakeroldname
+            speakeroldname = Speech.get_info(5, data)  # speakeroldname
             self.speaker_name = speakeroldname if speakeroldname else None
         if not self.topic:
             # subtopic or subsubtopic
-            if next(Speech.get_info(8, data)):
-                self.topic = next(Speech.get_info(8, data))
-            elif next(Speech.get_info(9, data)):
-                self.topic = next(Speech.get_info(9, data))
+            if Speech.get_info(8, data):
+                self.topic = Speech.get_info(8, data)
+            elif Speech.get_info(9, data):
+                self.topic = Speech.get_info(9, data)
             else:
                 self.topic = None
         if not self.speech_text:
@@ -205,20 +190,155 @@ class Speech(Base):
     def clean(self):
         self.speech_date = create_date(self.speech_date)
         self.speaker_name = clean_name(self.speaker_name)
+        self.speaker_id = Speaker.key(self.speaker_name) if self.speaker_name else None
         self.speech_text = self.clean_text()
         return self
 
     def clean_text(self) -> None | str:
+        """`clean_text` reduces the text to the filtered lemmas and keeps the
+        raw text and all tokens (see `SpeechTokens`)"""
         if not self.speech_text:
             return None
-        banned = config['SPEECH_CRITERIA']['BANNED_WORDS']
-        allowed_pos = config['SPEECH_CRITERIA']['WORD_TYPES']
-        doc = self.nlp(self.speech_text)
-        cleaned_text = ''
-        for token in doc:
-            if not token.is_stop and not token.lemma_ in banned and token.pos_ in allowed_pos:
-                cleaned_text += f' {token.lemma_}'
-        return cleaned_text
+        # boilerplate (e.g. "Some hon. Members: Hear, hear.") recurs often,
+        # its tokens are usually taken from the cache
+        tokens = analyse(self.speech_text)
+        self.tokens = SpeechTokens(raw_text=compress_text(self.speech_text),
+                                   tokens=encode_tokens(tokens))
+        self.tokens.lemmas = {lemma_id(t[0]): t[0] for t in tokens}
+        return filter_tokens(tokens)
+
+    def save(self, session) -> None:
+        self.save_all([self], session)
+
+    @classmethod
+    def save_all(cls, instances: list["Speech"], session) -> list[int]:
+        """Store a batch of speeches with their tokens, lemmas and speakers in
+        one transaction and return the ids of the stored ones; speeches which
+        are stored already are skipped by the database instead of raising
+        integrity errors, those without speaker are not stored"""
+        speeches = [s for s in instances if s.speaker_id is not None]
+        if len(speeches) < len(instances):
+            logging.getLogger('Speech.save_all').warning(
+                'Not storing %d speeches without speaker', len(instances) - len(speeches))
+        if not speeches:
+            return []
+        lemmas, speakers = {}, {}
+        for speech in speeches:
+            if speech.tokens is not None:
+                lemmas |= speech.tokens.lemmas
+            speakers[speech.speaker_id] = speech.speaker_name
+        table = cls.__table__
+        try:
+            Lemma.save_lemmas(lemmas, session)
+            Speaker.save_speakers(speakers, session)
+            stored = set(session.scalars(insert(table).on_conflict_do_nothing(
+                index_elements=[table.c.speech_id]).returning(table.c.speech_id),
+                cls.rows(speeches)))
+            # the ids are still strings of the csv
+            tokens = [{'speech_id': int(s.speech_id), 'raw_text': s.tokens.raw_text,
+                       'tokens': s.tokens.tokens}
+                      for s in speeches if int(s.speech_id) in stored and s.tokens is not None]
+            if tokens:
+                session.execute(insert(SpeechTokens.__table__).on_conflict_do_nothing(), tokens)
+            session.commit()
+        except sql.exc.DBAPIError as err:
+            logging.getLogger('Speech.save_all').error(
+                f"Problem ({err}): speeches {[s.speech_id for s in speeches]}")
+            session.rollback()
+            return []
+        return sorted(stored)
+
+
+class Speaker(Base):
+    """Dictionary of the (cleaned) speaker names of `Speech`"""
+
+    __tablename__ = "speaker"
+
+    speaker_id: Mapped[int] = mapped_column(sql.BigInteger, primary_key=True,
+                                            autoincrement=False)
+    name: Mapped[str] = mapped_column(sql.String)
+
+    def __repr__(self):
+        return f"Speaker({self.speaker_id!r}: {self.name!r})"
+
+    @staticmethod
+    def key(name: str) -> int:
+        """Stable 64-bit identifier of the speaker `name` (as `nlp.lemma_id`,
+        no coordination between writers is needed)"""
+        return lemma_id(name)
+
+    @staticmethod
+    def save_speakers(speakers: dict[int, str], session) -> None:
+        """Add the speakers which are not yet in the dictionary"""
+        if speakers:
+            stmt = insert(Speaker).on_conflict_do_nothing()
+            session.execute(stmt, [{'speaker_id': i, 'name': name}
+                                   for i, name in speakers.items()])
+
+
+# Full-text index of the cleaned speeches (lemmas), an external content table
+# which is kept in sync with `speech` by triggers (see `analysis.fulltext`)
+SPEECH_FTS = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS speech_fts USING fts5(
+        speech_text, content='speech', content_rowid='speech_id')""",
+    """CREATE TRIGGER IF NOT EXISTS speech_fts_insert AFTER INSERT ON speech BEGIN
+        INSERT INTO speech_fts (rowid, speech_text)
+        VALUES (new.speech_id, new.speech_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS speech_fts_delete AFTER DELETE ON speech BEGIN
+        INSERT INTO speech_fts (speech_fts, rowid, speech_text)
+        VALUES ('delete', old.speech_id, old.speech_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS speech_fts_update AFTER UPDATE OF speech_text ON speech BEGIN
+        INSERT INTO speech_fts (speech_fts, rowid, speech_text)
+        VALUES ('delete', old.speech_id, old.speech_text);
+        INSERT INTO speech_fts (rowid, speech_text)
+        VALUES (new.speech_id, new.speech_text);
+    END""",
+]
+for statement in SPEECH_FTS:
+    sql.event.listen(Speech.__table__, 'after_create',
+                     sql.DDL(statement).execute_if(dialect='sqlite'))
+
+
+class SpeechTokens(Base):
+    """Compressed raw text and token array of a speech, which allow to
+    regenerate `Speech.speech_text` for other filters without the pipeline"""
+
+    __tablename__ = "speech_tokens"
+
+    speech_id: Mapped[int] = mapped_column(
+        sql.Integer, sql.ForeignKey('speech.speech_id'), primary_key=True)
+    raw_text: Mapped[bytes] = mapped_column(sql.LargeBinary)
+    # see `nlp.encode_tokens`
+    tokens: Mapped[bytes] = mapped_column(sql.LargeBinary)
+
+    # lemma id -> lemma of the tokens, added to `Lemma` on saving
+    lemmas = None
+
+    def __repr__(self):
+        return f"SpeechTokens(speech_id: {self.speech_id!r}, ...)"
+
+
+class Lemma(Base):
+    """Dictionary of the lemma ids used in `SpeechTokens`"""
+
+    __tablename__ = "lemma"
+
+    lemma_id: Mapped[int] = mapped_column(sql.BigInteger, primary_key=True,
+                                          autoincrement=False)
+    lemma: Mapped[str] = mapped_column(sql.String)
+
+    def __repr__(self):
+        return f"Lemma({self.lemma_id!r}: {self.lemma!r})"
+
+    @staticmethod
+    def save_lemmas(lemmas: dict[int, str], session) -> None:
+        """Add the lemmas which are not yet in the dictionary"""
+        if lemmas:
+            stmt = insert(Lemma).on_conflict_do_nothing()
+            session.execute(stmt, [{'lemma_id': i, 'lemma': lemma}
+                                   for i, lemma in lemmas.items()])
 
 
 class ElectionCandidate(Base):
@@ -249,9 +369,9 @@ class ElectionCandidate(Base):
         return f"ElectionCandidate(identifier: {self.identifier!r}, election_id: {self.election_id!r} ...)"
 
     @staticmethod
-    def get_info(key, data):
+    def get_info(key, record):
         # here data already is one entry!
-        yield data.find(key).text
+        return record.find(key).text
 
     def clean(self):
         self.election_date = create_date(self.election_date)
@@ -275,9 +395,6 @@ class ParliamentSession(Base):
     def __repr__(self):
         return f"Session({self.start_date} - {self.end_date})"
 
-    def get_info(key, data):
-        yield data[key]
-
     def handle_missing(self):
         if not self.end_date:
             self.end_date = '2050-01-01'
@@ -297,11 +414,35 @@ class SpeechLink(Base):
     identifier: Mapped[int] = mapped_column(
         sql.Integer, sql.ForeignKey('personal_information'))
     # not a primary key because we might get the same id through a full
-    # and a last name match!
-    name: Mapped[str] = mapped_column(sql.String, nullable=False)
+    # and a last name match! (`Speaker.key` of the linked name, which need
+    # not be in `Speaker`)
+    speaker_id: Mapped[int] = mapped_column(sql.BigInteger, nullable=False)
+    # parliament in which the link is valid (None: in every parliament)
+    parliament: Mapped[int] = mapped_column(sql.Integer, nullable=True)
+
+    # linked name (see `processing.link_speech.new_link`)
+    name = None
 
     def __repr__(self):
-        return f'SpeechLink(identifier: {self.identifier}, name: {self.name})'
+        return f'SpeechLink(identifier: {self.identifier}, speaker_id: {self.speaker_id})'
+
+
+class LinkDecision(Base):
+    """Outcome of linking a speaker name, which is reused as long as the
+    roster of parliamentarians (and the matching rules) stay the same"""
+    __tablename__ = 'link_decision'
+    # speaker name as stored in `Speaker.name`
+    name: Mapped[str] = mapped_column(sql.String, primary_key=True)
+    # 0 if the speaker was matched against all parliamentarians
+    parliament: Mapped[int] = mapped_column(sql.Integer, primary_key=True)
+    roster: Mapped[str] = mapped_column(sql.String)
+    rule: Mapped[str] = mapped_column(sql.String)
+    # the created `SpeechLink` (if any)
+    identifier: Mapped[int] = mapped_column(sql.Integer, nullable=True)
+    link_name: Mapped[str] = mapped_column(sql.String, nullable=True)
+
+    def __repr__(self):
+        return f'LinkDecision(name: {self.name}, rule: {self.rule}, identifier: {self.identifier})'
 
 
 class Sample(Base):
@@ -324,3 +465,357 @@ class TopicPrediction(Base):
 
     def __repr__(self):
         return f'TopicPrediction(speech_id: {self.speech_id}, topic: {self.topic})'
+
+
+# Natural keys ----------------------------------------------------------------
+
+
+def natural_key(model: type[Base], *elements) -> None:
+    """Create the unique index of the natural key of `model`, on which
+    `Base.save_all` upserts (nullable columns are coalesced, as NULLs are never
+    equal in a unique index)"""
+    model.natural_key = elements
+    sql.Index(f'{model.__tablename__}_key', *elements, unique=True)
+
+
+def coalesce(column, default: str):
+    """`column` with NULL replaced by `default` (SQL literal, as the
+    expression of an upsert has to equal the one of the index)"""
+    return sql.func.coalesce(column, sql.literal_column(default))
+
+
+natural_key(Membership, Membership.identifier, Membership.parliament, Membership.type,
+            coalesce(Membership.session, '-1'), coalesce(Membership.organization, "''"),
+            coalesce(Membership.role, "''"))
+natural_key(Election, Election.identifier, Election.parliament, Election.election_date,
+            Election.constituency)
+natural_key(Experience, Experience.identifier, Experience.section, Experience.start_date,
+            coalesce(Experience.organization, "''"), coalesce(Experience.role, "''"))
+# candidates who were never members of parliament have no person id
+natural_key(ElectionCandidate, coalesce(ElectionCandidate.election_id, '-1'),
+            coalesce(ElectionCandidate.constituency, "''"),
+            coalesce(ElectionCandidate.person_id, '-1'), ElectionCandidate.votes)
+natural_key(ParliamentSession, ParliamentSession.parliament, ParliamentSession.session)
+
+
+def create_natural_keys(target, connection, **kw) -> None:
+    """Create the unique indexes of the natural keys in databases created
+    before they existed, dropping the duplicated rows first (the first one
+    is kept)"""
+    if connection.dialect.name != 'sqlite':
+        return
+    inspector = sql.inspect(connection)
+    deleted = {}
+    for model in [Membership, Election, Experience, ElectionCandidate, ParliamentSession]:
+        table = model.__table__
+        name = f'{table.name}_key'
+        # the reflection of SQLite skips indexes on expressions
+        if not inspector.has_table(table.name) or connection.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                (name,)).first():
+            continue
+        primary_key = list(table.primary_key.columns)[0]
+        first = sql.select(sql.func.min(primary_key)).group_by(*model.natural_key)
+        deleted[table.name] = connection.execute(
+            table.delete().where(primary_key.not_in(first))).rowcount
+        index, = (i for i in table.indexes if i.name == name)
+        connection.execute(sql.schema.CreateIndex(index, if_not_exists=True))
+    if any(deleted.values()):
+        logging.getLogger('create_natural_keys').info('Removed duplicates: %s', deleted)
+    # the speeches of a duplicated parliament were counted twice
+    if deleted.get(ParliamentSession.__tablename__) and inspector.has_table('topic_prediction'):
+        rebuild_topic_aggregates(connection)
+
+
+# Aggregates ------------------------------------------------------------------
+
+
+class TopicCount(Base):
+    """Number of speeches per member of parliament, parliament and topic (the
+    rows of `get_speech_df`), maintained by triggers"""
+    __tablename__ = 'topic_count'
+
+    identifier: Mapped[int] = mapped_column(sql.Integer, primary_key=True)
+    parliament: Mapped[int] = mapped_column(sql.Integer, primary_key=True)
+    topic: Mapped[int] = mapped_column(sql.Integer, primary_key=True)
+    speeches: Mapped[int] = mapped_column(sql.Integer)
+
+    def __repr__(self):
+        return f'TopicCount({self.identifier}, {self.parliament}, {self.topic}: {self.speeches})'
+
+
+class TopicMonth(Base):
+    """Number of speeches per month (YYYY-MM) and topic, maintained by
+    triggers"""
+    __tablename__ = 'topic_month'
+
+    month: Mapped[str] = mapped_column(sql.String, primary_key=True)
+    topic: Mapped[int] = mapped_column(sql.Integer, primary_key=True)
+    speeches: Mapped[int] = mapped_column(sql.Integer)
+
+    def __repr__(self):
+        return f'TopicMonth({self.month}, {self.topic}: {self.speeches})'
+
+
+# speeches joined to their parliament and links as in `get_speech_df`
+SPEECH_LINK_JOIN = """speech s
+    JOIN parliament p ON p.start_date <= s.speech_date AND p.end_date >= s.speech_date
+    JOIN speech_links l ON l.speaker_id = s.speaker_id
+        AND (l.parliament IS NULL OR l.parliament = p.parliament)"""
+
+
+def count_prediction(row: str, sign: str) -> str:
+    """Statements adding (sign '+') or removing (sign '-') the prediction
+    `row` (new or old) to the aggregates"""
+    return f"""
+        INSERT INTO topic_count (identifier, parliament, topic, speeches)
+        SELECT l.identifier, p.parliament, {row}.topic, {sign}count(*)
+        FROM {SPEECH_LINK_JOIN}
+        WHERE s.speech_id = {row}.speech_id AND l.identifier IS NOT NULL
+        GROUP BY l.identifier, p.parliament
+        ON CONFLICT (identifier, parliament, topic)
+        DO UPDATE SET speeches = speeches + excluded.speeches;
+        INSERT INTO topic_month (month, topic, speeches)
+        SELECT strftime('%Y-%m', s.speech_date), {row}.topic, {sign}1
+        FROM speech s WHERE s.speech_id = {row}.speech_id
+        ON CONFLICT (month, topic) DO UPDATE SET speeches = speeches + excluded.speeches;"""
+
+
+def count_link(row: str, sign: str) -> str:
+    """Statement adding or removing the predicted speeches of the link `row`"""
+    return f"""
+        INSERT INTO topic_count (identifier, parliament, topic, speeches)
+        SELECT {row}.identifier, p.parliament, t.topic, {sign}count(*)
+        FROM speech s
+        JOIN topic_prediction t ON t.speech_id = s.speech_id
+        JOIN parliament p ON p.start_date <= s.speech_date AND p.end_date >= s.speech_date
+        WHERE s.speaker_id = {row}.speaker_id AND {row}.identifier IS NOT NULL
+            AND ({row}.parliament IS NULL OR {row}.parliament = p.parliament)
+        GROUP BY p.parliament, t.topic
+        ON CONFLICT (identifier, parliament, topic)
+        DO UPDATE SET speeches = speeches + excluded.speeches;"""
+
+
+# Changes of the speeches or parliaments themselves are not tracked, which
+# requires `rebuild_topic_aggregates`
+TOPIC_AGGREGATES = [
+    'CREATE INDEX IF NOT EXISTS main.speech_speaker ON speech (speaker_id)',
+    'CREATE INDEX IF NOT EXISTS main.speech_links_speaker ON speech_links (speaker_id)',
+    f"""CREATE TRIGGER IF NOT EXISTS topic_prediction_insert
+    AFTER INSERT ON topic_prediction BEGIN {count_prediction('new', '+')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS topic_prediction_delete
+    AFTER DELETE ON topic_prediction BEGIN {count_prediction('old', '-')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS topic_prediction_update
+    AFTER UPDATE ON topic_prediction BEGIN {count_prediction('old', '-')}
+    {count_prediction('new', '+')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS speech_links_insert
+    AFTER INSERT ON speech_links BEGIN {count_link('new', '+')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS speech_links_delete
+    AFTER DELETE ON speech_links BEGIN {count_link('old', '-')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS speech_links_update
+    AFTER UPDATE ON speech_links BEGIN {count_link('old', '-')}
+    {count_link('new', '+')}
+    END""",
+]
+
+TOPIC_AGGREGATES_REBUILD = [
+    'DELETE FROM topic_count',
+    f"""INSERT INTO topic_count (identifier, parliament, topic, speeches)
+    SELECT l.identifier, p.parliament, t.topic, count(*)
+    FROM {SPEECH_LINK_JOIN}
+    JOIN topic_prediction t ON t.speech_id = s.speech_id
+    WHERE l.identifier IS NOT NULL
+    GROUP BY l.identifier, p.parliament, t.topic""",
+    'DELETE FROM topic_month',
+    """INSERT INTO topic_month (month, topic, speeches)
+    SELECT strftime('%Y-%m', s.speech_date), t.topic, count(*)
+    FROM speech s JOIN topic_prediction t ON t.speech_id = s.speech_id
+    GROUP BY 1, 2""",
+]
+
+
+def rebuild_topic_aggregates(connection) -> None:
+    """Recompute the aggregate tables from scratch"""
+    for statement in TOPIC_AGGREGATES_REBUILD:
+        connection.exec_driver_sql(statement)
+
+
+# predictions inserted at once by `replace_topic_predictions`
+CHUNK_SIZE = 10000
+
+
+def begin_transaction(connection) -> None:
+    """Open the transaction of the SQLite driver explicitly: pysqlite only
+    begins one before DML and commits DDL run before at once, so that e.g. a
+    dropped trigger would outlast a rollback"""
+    if not connection.connection.driver_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN')
+
+
+def replace_topic_predictions(rows: list[dict], connection) -> None:
+    """Replace all topic predictions by `rows` (speech_id, topic) in bulk:
+    the triggers of the predictions are dropped meanwhile and the aggregates
+    rebuilt once, all within one transaction of `connection`"""
+    begin_transaction(connection)
+    for event in ['insert', 'delete', 'update']:
+        connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS topic_prediction_{event}')
+    connection.execute(sql.delete(TopicPrediction))
+    for start in range(0, len(rows), CHUNK_SIZE):
+        connection.execute(sql.insert(TopicPrediction), rows[start:start + CHUNK_SIZE])
+    for statement in TOPIC_AGGREGATES:
+        connection.exec_driver_sql(statement)
+    rebuild_topic_aggregates(connection)
+
+
+def create_topic_aggregates(target, connection, tables=(), **kw) -> None:
+    """Create the triggers (also in databases created before they existed)
+    and fill the aggregate tables if they are new or empty despite
+    predictions (e.g. left so by a failed migration)"""
+    # e.g. shards of the speeches (see `shards`)
+    if connection.dialect.name != 'sqlite' or not sql.inspect(connection).has_table('topic_prediction'):
+        return
+    for statement in TOPIC_AGGREGATES:
+        connection.exec_driver_sql(statement)
+    empty = connection.exec_driver_sql(
+        'SELECT NOT EXISTS (SELECT 1 FROM topic_month) AND EXISTS (SELECT 1 FROM topic_prediction)'
+    ).scalar()
+    if TopicCount.__table__ in tables or TopicMonth.__table__ in tables or empty:
+        rebuild_topic_aggregates(connection)
+
+
+def migrate_link_parliaments(target, connection, **kw) -> None:
+    """Add the parliament of the links and decisions to databases created
+    before the links were partitioned by parliament"""
+    if connection.dialect.name != 'sqlite':
+        return
+    inspector = sql.inspect(connection)
+    if inspector.has_table('speech_links') and 'parliament' not in {
+            c['name'] for c in inspector.get_columns('speech_links')}:
+        # the existing links are valid in every parliament
+        connection.exec_driver_sql('ALTER TABLE speech_links ADD COLUMN parliament INTEGER')
+    key = inspector.get_pk_constraint('link_decision')['constrained_columns']
+    if 'parliament' not in key:
+        # decisions only save time, they are made again
+        LinkDecision.__table__.drop(connection)
+        LinkDecision.__table__.create(connection)
+
+
+# Databases created when the speeches and links stored the speaker names: the
+# triggers and indexes which use the names are dropped (and recreated by
+# `create_topic_aggregates`); VACUUM reclaims the space afterwards
+SPEAKER_MIGRATION = [
+    *[f'DROP TRIGGER IF EXISTS {t}_{event}' for t in ['topic_prediction', 'speech_links']
+      for event in ['insert', 'delete', 'update']],
+    'DROP INDEX IF EXISTS speech_speaker_name',
+    'DROP INDEX IF EXISTS speech_links_name',
+    'ALTER TABLE speech ADD COLUMN speaker_id BIGINT REFERENCES speaker (speaker_id)',
+    """INSERT OR IGNORE INTO speaker (speaker_id, name)
+    SELECT speaker_key(speaker_name), speaker_name FROM speech
+    WHERE speaker_name IS NOT NULL GROUP BY speaker_name""",
+    'UPDATE speech SET speaker_id = speaker_key(speaker_name)',
+    'ALTER TABLE speech DROP COLUMN speaker_name',
+]
+
+SPEAKER_LINK_MIGRATION = [
+    'ALTER TABLE speech_links ADD COLUMN speaker_id BIGINT NOT NULL DEFAULT 0',
+    'UPDATE speech_links SET speaker_id = speaker_key(name)',
+    'ALTER TABLE speech_links DROP COLUMN name',
+]
+
+
+def migrate_speaker_names(target, connection, **kw) -> None:
+    """Replace the speaker names of the speeches and links of an existing
+    database by the ids of `Speaker`"""
+    if connection.dialect.name != 'sqlite':
+        return
+    inspector = sql.inspect(connection)
+    columns = {c['name'] for c in inspector.get_columns('speech')}
+    if 'speaker_name' not in columns:
+        return
+    connection.connection.driver_connection.create_function(
+        'speaker_key', 1, lambda name: Speaker.key(name) if name else None,
+        deterministic=True)
+    statements = SPEAKER_MIGRATION
+    if inspector.has_table('speech_links'):
+        statements = statements + SPEAKER_LINK_MIGRATION
+    # applied entirely or not at all, a later start would skip the rest
+    begin_transaction(connection)
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+    # the triggers were dropped while the ids replaced the names
+    if inspector.has_table('topic_prediction'):
+        rebuild_topic_aggregates(connection)
+
+
+# in order, before the triggers are created
+sql.event.listen(Base.metadata, 'after_create', migrate_link_parliaments)
+sql.event.listen(Base.metadata, 'after_create', migrate_speaker_names)
+# rebuilds the aggregates, which requires the ids of the speakers
+sql.event.listen(Base.metadata, 'after_create', create_natural_keys)
+sql.event.listen(Base.metadata, 'after_create', create_topic_aggregates)
+
+
+# Stages ----------------------------------------------------------------------
+
+
+class StageFingerprint(Base):
+    """Fingerprint of the configuration and inputs of the last run of a Task
+    and of its outputs after the run (see `stages`)"""
+    __tablename__ = 'stage_fingerprint'
+
+    stage: Mapped[str] = mapped_column(sql.String, primary_key=True)
+    fingerprint: Mapped[str] = mapped_column(sql.String)
+    outputs: Mapped[str] = mapped_column(sql.String)
+    # printed output of the run, repeated when it is skipped
+    output: Mapped[str] = mapped_column(sql.Text)
+    updated: Mapped[datetime] = mapped_column(sql.DateTime)
+
+    def __repr__(self):
+        return f'StageFingerprint({self.stage}: {self.fingerprint})'
+
+
+class TableVersion(Base):
+    """Number of Task runs which wrote a table, as the row count alone does
+    not reveal rewrites"""
+    __tablename__ = 'table_version'
+
+    name: Mapped[str] = mapped_column(sql.String, primary_key=True)
+    version: Mapped[int] = mapped_column(sql.Integer)
+
+    def __repr__(self):
+        return f'TableVersion({self.name}: {self.version})'
+
+
+# Work queue ------------------------------------------------------------------
+
+
+class Job(Base):
+    """Item of a download Task in the shared work queue (see
+    `download.work_queue`): pending, leased by a worker until `lease_expires`,
+    done or, after QUEUE.MAX_ATTEMPTS failed attempts, dead"""
+    __tablename__ = 'job_queue'
+    __table_args__ = (sql.UniqueConstraint('task', 'item'),
+                      sql.Index('job_queue_state', 'state', 'available'))
+
+    job_id: Mapped[int] = mapped_column(sql.Integer, primary_key=True)
+    task: Mapped[str] = mapped_column(sql.String)
+    # JSON encoded item passed to the worker of the Task
+    item: Mapped[str] = mapped_column(sql.Text)
+    # first year of the shard of a speech (see `shards`)
+    shard: Mapped[int] = mapped_column(sql.Integer, nullable=True)
+    state: Mapped[str] = mapped_column(sql.String, default='pending')
+    attempts: Mapped[int] = mapped_column(sql.Integer, default=0)
+    # not claimed before (a failed job waits QUEUE.RETRY_DELAY)
+    available: Mapped[datetime] = mapped_column(sql.DateTime)
+    worker: Mapped[str] = mapped_column(sql.String, nullable=True)
+    lease_expires: Mapped[datetime] = mapped_column(sql.DateTime, nullable=True)
+    error: Mapped[str] = mapped_column(sql.Text, nullable=True)
+    updated: Mapped[datetime] = mapped_column(sql.DateTime)
+
+    def __repr__(self):
+        return f'Job({self.job_id}: {self.task} {self.item}, {self.state})'
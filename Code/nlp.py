@@ -0,0 +1,244 @@
+# ~/Code/nlp.py
+
+"""Lazy access to the spaCy pipeline used for cleaning speeches, a
+persistent cache of its results and the compact token format stored for each
+speech"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from array import array
+from functools import cache
+from importlib import metadata
+
+from config import config
+
+
+@cache
+def load_model():
+    """`load_model` loads the spaCy pipeline on first use only, so that stages
+    which never clean a speech do not pay for it"""
+    import spacy
+    return spacy.load(config['SPEECH_CRITERIA']['NLP_MODEL'])
+
+
+# Cache -----------------------------------------------------------------------
+
+
+# Tokens are cached and stored unfiltered, which is why WORD_TYPES and
+# BANNED_WORDS are not part of the fingerprint: they are applied afterwards
+TOKEN_FORMAT = 'lemma-pos-stop-1'
+
+
+def model_version() -> str:
+    """Version of the pipeline package or, e.g. for a pipeline loaded from a
+    path, of the loaded pipeline (the one of the service if it is used)"""
+    name = config['SPEECH_CRITERIA']['NLP_MODEL']
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        pass
+    service = get_service()
+    if service is not None:
+        try:
+            return service.info()['version']
+        except (OSError, RuntimeError) as err:
+            disable_service(err)
+    return load_model().meta['version']
+
+
+@cache
+def settings_fingerprint() -> bytes:
+    """Hash of everything besides the raw text that determines the tokens:
+    pipeline name and version and the token format"""
+    name = config['SPEECH_CRITERIA']['NLP_MODEL']
+    settings = [name, model_version(), TOKEN_FORMAT]
+    return hashlib.blake2b(json.dumps(settings).encode()).digest()
+
+
+def cache_key(text: str) -> bytes:
+    """Content address of the tokens of `text`"""
+    h = hashlib.blake2b(settings_fingerprint())
+    h.update(text.encode('utf-8'))
+    return h.digest()
+
+
+class NLPCache:
+    """SQLite cache of token lists (as JSON) which evicts the least recently used
+    entries once it holds more than `max_entries`"""
+
+    # check the size after this many insertions
+    EVICTION_INTERVAL = 1000
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self.inserted = 0
+        self.lock = threading.Lock()
+        # shared by the writer processes of sharded speeches (see `shards`)
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS nlp_cache '
+                          '(key BLOB PRIMARY KEY, result TEXT, used INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS nlp_cache_used '
+                          'ON nlp_cache (used)')
+
+    def get(self, key: bytes) -> str | None:
+        """Cached result for `key` (None if missing)"""
+        with self.lock:
+            row = self.conn.execute('SELECT result FROM nlp_cache WHERE key = ?',
+                                    (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE nlp_cache SET used = ? WHERE key = ?',
+                              (time.time_ns(), key))
+        return row[0]
+
+    def put(self, key: bytes, result: str) -> None:
+        """Store `result` under `key`"""
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO nlp_cache VALUES (?, ?, ?)',
+                              (key, result, time.time_ns()))
+            self.inserted += 1
+            if self.inserted % self.EVICTION_INTERVAL == 0:
+                self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently used entries beyond `max_entries`"""
+        size = self.conn.execute('SELECT count(*) FROM nlp_cache').fetchone()[0]
+        if size > self.max_entries:
+            self.conn.execute('DELETE FROM nlp_cache WHERE key IN (SELECT key '
+                              'FROM nlp_cache ORDER BY used LIMIT ?)',
+                              (size - self.max_entries,))
+
+
+@cache
+def get_cache() -> NLPCache:
+    """`get_cache` opens the cache shared by all threads of the process"""
+    return NLPCache(config['FILES']['NLP_CACHE'],
+                    config['NLP_CACHE']['MAX_ENTRIES'])
+
+
+# Service ---------------------------------------------------------------------
+
+
+_service = {'client': None, 'checked': False}
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """`get_service` connects to the NLP service (see `nlp_service`) if it is
+    enabled; None if it is disabled, not running or serves another pipeline"""
+    settings = config['NLP_SERVICE']
+    if not settings['ENABLED']:
+        return None
+    with _service_lock:
+        if _service['checked']:
+            return _service['client']
+        _service['checked'] = True
+        from nlp_service import NLPClient
+        client = NLPClient(settings['SOCKET'], settings['TIMEOUT'])
+        try:
+            info = client.info()
+        except (OSError, RuntimeError) as err:
+            logging.getLogger(__name__).warning(
+                'NLP service not available (%s), loading the pipeline', err)
+            return None
+        if info['model'] != config['SPEECH_CRITERIA']['NLP_MODEL']:
+            logging.getLogger(__name__).warning(
+                'NLP service runs %s, loading the pipeline', info['model'])
+            return None
+        _service['client'] = client
+        return client
+
+
+def disable_service(error: Exception) -> None:
+    """Fall back to the pipeline of this process after the service failed"""
+    logging.getLogger(__name__).warning(
+        'NLP service failed (%r), loading the pipeline', error)
+    with _service_lock:
+        _service['client'] = None
+
+
+# Tokens ----------------------------------------------------------------------
+
+Token = tuple[str, str, bool]  # lemma, part of speech, stopword
+
+# Universal part-of-speech tags used by spaCy (index = POS id)
+POS_TAGS = ['', 'ADJ', 'ADP', 'ADV', 'AUX', 'CCONJ', 'DET', 'INTJ', 'NOUN',
+            'NUM', 'PART', 'PRON', 'PROPN', 'PUNCT', 'SCONJ', 'SYM', 'VERB',
+            'X', 'SPACE']
+POS_IDS = {pos: i for i, pos in enumerate(POS_TAGS)}
+STOP_FLAG = 0x80
+
+
+def tokenize_local(texts: list[str]) -> list[list[Token]]:
+    """Run the pipeline of this process on `texts`"""
+    return [[(t.lemma_, t.pos_, t.is_stop) for t in doc] for doc in load_model().pipe(texts)]
+
+
+def tokenize(texts: list[str]) -> list[list[Token]]:
+    """Run the pipeline of the service (if used) or of this process on `texts`"""
+    service = get_service()
+    if service is not None:
+        try:
+            return service.tokenize(texts)
+        except (OSError, RuntimeError) as err:
+            disable_service(err)
+    return tokenize_local(texts)
+
+
+def analyse_many(texts: list[str]) -> list[list[Token]]:
+    """Tokens of `texts`, of those which are not cached from one batch (a
+    single request to the service)"""
+    keys = [cache_key(text) for text in texts]
+    results = [get_cache().get(key) for key in keys]
+    tokens = [None if r is None else [tuple(t) for t in json.loads(r)] for r in results]
+    missing = [i for i, t in enumerate(tokens) if t is None]
+    if missing:
+        for i, new in zip(missing, tokenize([texts[i] for i in missing])):
+            tokens[i] = new
+            get_cache().put(keys[i], json.dumps(new))
+    return tokens
+
+
+def analyse(text: str) -> list[Token]:
+    """Run the pipeline on `text` unless its tokens are already cached"""
+    return analyse_many([text])[0]
+
+
+def filter_tokens(tokens: list[Token]) -> str:
+    """Keep the lemmas of non-stopwords of the allowed word types which are
+    not banned (see config)"""
+    banned = set(config['SPEECH_CRITERIA']['BANNED_WORDS'])
+    allowed_pos = config['SPEECH_CRITERIA']['WORD_TYPES']
+    return ''.join(f' {lemma}' for lemma, pos, is_stop in tokens
+                   if not is_stop and lemma not in banned and pos in allowed_pos)
+
+
+def lemma_id(lemma: str) -> int:
+    """Stable 64-bit identifier of `lemma`; being derived from the lemma
+    itself, no coordination between writers is needed"""
+    digest = hashlib.blake2b(lemma.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def encode_tokens(tokens: list[Token]) -> bytes:
+    """Compressed token array: all lemma ids (int64), followed by one byte per
+    token holding the POS id and the stopword flag"""
+    ids = array('q', (lemma_id(lemma) for lemma, _, _ in tokens))
+    tags = array('B', (POS_IDS.get(pos, POS_IDS['X']) | (STOP_FLAG if is_stop else 0)
+                       for _, pos, is_stop in tokens))
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    return zlib.compress(ids.tobytes() + tags.tobytes())
+
+
+def compress_text(text: str) -> bytes:
+    """Compressed raw text"""
+    return zlib.compress(text.encode('utf-8'))
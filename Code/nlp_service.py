@@ -0,0 +1,170 @@
+# ~/Code/nlp_service.py
+
+"""Local service which keeps the spaCy pipeline loaded in a pool of worker
+processes and tokenizes batches of texts for other processes over a Unix
+socket (see NLP_SERVICE in the config), e.g. started by
+
+    python code nlp-service
+
+`nlp.analyse` uses it when it is enabled and running, so that short runs do
+not load the pipeline themselves. Messages are JSON objects preceded by their
+length (4 bytes)"""
+
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+import nlp
+from config import config
+
+
+logger = logging.getLogger(__name__)
+
+# texts tokenized by a worker process at once
+CHUNK_SIZE = 64
+
+
+def send_message(sock: socket.socket, message: dict) -> None:
+    """Send a JSON object preceded by its length"""
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def receive_exactly(sock: socket.socket, n: int) -> bytes:
+    """Read `n` bytes (raises ConnectionError if the peer closed)"""
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def receive_message(sock: socket.socket) -> dict:
+    """Receive a JSON object preceded by its length"""
+    n, = struct.unpack('>I', receive_exactly(sock, 4))
+    return json.loads(receive_exactly(sock, n))
+
+
+# Server ----------------------------------------------------------------------
+
+
+def warm_up(settings: dict) -> None:
+    """Load the pipeline in a worker process with the configuration of the
+    service"""
+    config.clear()
+    config.update(settings)
+    # the workers run the pipeline themselves
+    config['NLP_SERVICE']['ENABLED'] = False
+    nlp.load_model()
+
+
+def model_info() -> dict:
+    """Name and version of the pipeline (in a worker process)"""
+    return {'model': config['SPEECH_CRITERIA']['NLP_MODEL'],
+            'version': nlp.model_version()}
+
+
+class Handler(socketserver.BaseRequestHandler):
+    """Answer the requests of a connection: {'texts': [...]} with the tokens
+    of each text, {'info': true} with the pipeline name and version"""
+
+    def handle(self):
+        pool = self.server.pool
+        while True:
+            try:
+                request = receive_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                if request.get('info'):
+                    response = pool.apply(model_info)
+                else:
+                    texts = request['texts']
+                    chunks = [texts[i:i + CHUNK_SIZE] for i in range(0, len(texts), CHUNK_SIZE)]
+                    response = {'tokens': [tokens for chunk in pool.map(nlp.tokenize_local, chunks)
+                                           for tokens in chunk]}
+            except Exception as err:
+                logger.exception('Request failed')
+                response = {'error': repr(err)}
+            try:
+                send_message(self.request, response)
+            except OSError:
+                return  # the client is gone
+
+
+class NLPServer(socketserver.ThreadingUnixStreamServer):
+    """Server of the pipeline in `workers` processes"""
+
+    daemon_threads = True
+
+    def __init__(self, path: str, workers: int):
+        # spawned rather than forked, as the parent runs threads (e.g. logging)
+        self.pool = multiprocessing.get_context('spawn').Pool(
+            workers, initializer=warm_up, initargs=(config.copy(),))
+        # loaded before the socket exists, clients load the pipeline meanwhile
+        self.info = self.pool.apply(model_info)
+        if os.path.exists(path):
+            os.remove(path)  # left behind by a server which was killed
+        super().__init__(path, Handler)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.terminate()
+        os.remove(self.server_address)
+
+
+def serve(path: str | None = None, workers: int | None = None) -> NLPServer:
+    """Start the service in a background thread"""
+    settings = config['NLP_SERVICE']
+    server = NLPServer(path or settings['SOCKET'], workers or settings['WORKERS'] or os.cpu_count())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Serving %s on %s', server.info, server.server_address)
+    return server
+
+
+# Client ----------------------------------------------------------------------
+
+
+class NLPClient:
+    """Connection of each thread to the service"""
+
+    def __init__(self, path: str, timeout: float):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def request(self, message: dict) -> dict:
+        """Send `message` and return the response (raises OSError if the
+        service is not running)"""
+        sock = getattr(self.local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self.local.sock = sock
+        try:
+            send_message(sock, message)
+            response = receive_message(sock)
+        except OSError:
+            sock.close()
+            self.local.sock = None
+            raise
+        if 'error' in response:
+            raise RuntimeError(f'NLP service: {response["error"]}')
+        return response
+
+    def tokenize(self, texts: list[str]) -> list[list[nlp.Token]]:
+        """Tokens of each of `texts`"""
+        tokens = self.request({'texts': texts})['tokens']
+        return [[tuple(t) for t in text_tokens] for text_tokens in tokens]
+
+    def info(self) -> dict:
+        """Name and version of the pipeline of the service"""
+        return self.request({'info': True})
@@ -0,0 +1,155 @@
+"""Benchmark of the linking of speakers to members of parliament (see
+`link_speech.decide_link`) on the labelled names of `link_benchmark.yaml`: it
+reports the speakers decided per second, precision and recall of the links and
+per rule that fired the decisions, correct and wrong links and ambiguous drops.
+Alternative matchers (functions with the signature of `decide_link`) are
+compared with the current one, e.g.
+
+    python -m processing.link_benchmark --matcher my_module:decide_link
+
+(from the directory `Code`). Links are compared by the identifier of the
+member of parliament only, as the rule `best` stores the link under the name
+of the member instead of the speaker"""
+
+import argparse
+import importlib
+import os
+import time
+from collections import Counter, namedtuple
+from typing import Callable
+
+import yaml
+
+from helpers import clean_name, logged
+from processing.link_speech import Parl, decide_link, join_names
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'link_benchmark.yaml')
+
+Case = namedtuple('Case', ['speaker', 'name', 'identifier', 'tag'])
+
+Outcome = namedtuple('Outcome', ['case', 'identifier', 'rule'])
+
+BenchmarkResult = namedtuple('BenchmarkResult', ['outcomes', 'speakers_per_sec',
+                                                 'precision', 'recall'])
+
+Matcher = Callable[[str, list[Parl]], tuple]
+
+
+def load_fixture(path: str = FIXTURE) -> tuple[list[Parl], list[Case]]:
+    """Roster and labelled speakers of the fixture, with the names cleaned as
+    those of the database"""
+    with open(path, encoding='utf-8') as file:
+        fixture = yaml.safe_load(file)
+    p_set = []
+    for p in fixture['roster']:
+        first, last = clean_name(p['first_name']), clean_name(p['last_name'])
+        p_set.append(Parl(join_names((first, last)), first, last, p['identifier']))
+    cases = [Case(c['speaker'], clean_name(c['speaker']), c['identifier'], c['tag'])
+             for c in fixture['cases']]
+    return p_set, cases
+
+
+def evaluate(matcher: Matcher, p_set: list[Parl], cases: list[Case],
+             repeat: int = 20) -> BenchmarkResult:
+    """Decide the links of `cases` `repeat` times with `matcher`, which
+    returns the link (or None) and the rule that fired"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decisions = [matcher(c.name, p_set) for c in cases]
+    elapsed = time.perf_counter() - start
+    outcomes = [Outcome(c, link.identifier if link is not None else None, rule)
+                for c, (link, rule) in zip(cases, decisions)]
+    linked = [o for o in outcomes if o.identifier is not None]
+    correct = sum(o.identifier == o.case.identifier for o in linked)
+    expected = sum(c.identifier is not None for c in cases)
+    return BenchmarkResult(outcomes=outcomes,
+                           speakers_per_sec=len(cases) * repeat / elapsed,
+                           precision=correct / len(linked) if linked else float('nan'),
+                           recall=correct / expected if expected else float('nan'))
+
+
+def by_rule(result: BenchmarkResult) -> dict[str, Counter]:
+    """Decisions, correct and wrong links and drops of members (ambiguous
+    ones separately) per rule"""
+    rules = {}
+    for o in result.outcomes:
+        counts = rules.setdefault(o.rule, Counter())
+        counts['decisions'] += 1
+        if o.identifier is not None:
+            counts['correct' if o.identifier == o.case.identifier else 'wrong'] += 1
+        elif o.case.identifier is not None:
+            counts['ambiguous' if o.rule.endswith('ambiguous') else 'missed'] += 1
+    return rules
+
+
+def by_tag(result: BenchmarkResult) -> dict[str, Counter]:
+    """Cases and correct decisions (links or drops of non-members) per tag"""
+    tags = {}
+    for o in result.outcomes:
+        counts = tags.setdefault(o.case.tag, Counter())
+        counts['cases'] += 1
+        counts['correct'] += o.identifier == o.case.identifier
+    return tags
+
+
+def diff(baseline: BenchmarkResult, other: BenchmarkResult) -> list[tuple]:
+    """Speakers which `other` links differently from `baseline`: speaker,
+    expected identifier and identifier and rule of both"""
+    return [(b.case.speaker, b.case.identifier, b.identifier, b.rule, o.identifier, o.rule)
+            for b, o in zip(baseline.outcomes, other.outcomes)
+            if b.identifier != o.identifier]
+
+
+def report(name: str, result: BenchmarkResult) -> None:
+    """Print the summary of a matcher"""
+    print(f'{name}: {result.speakers_per_sec:,.0f} speakers/s, '
+          f'precision {result.precision:.3f}, recall {result.recall:.3f}')
+    columns = ['decisions', 'correct', 'wrong', 'ambiguous', 'missed']
+    print(f'  {"rule":<22}' + ''.join(f'{c:>11}' for c in columns))
+    for rule, counts in sorted(by_rule(result).items()):
+        print(f'  {rule:<22}' + ''.join(f'{counts[c]:>11}' for c in columns))
+    for tag, counts in by_tag(result).items():
+        print(f'  {tag}: {counts["correct"]} of {counts["cases"]} correct')
+
+
+def load_matcher(path: str) -> Matcher:
+    """Function given as 'module:function'"""
+    module, function = path.split(':')
+    return getattr(importlib.import_module(module), function)
+
+
+@logged
+def run_benchmark(matchers: dict[str, Matcher], path: str = FIXTURE,
+                  repeat: int = 20) -> dict[str, BenchmarkResult]:
+    """Evaluate the current and the given matchers and print their summaries
+    and the speakers they link differently from the current one"""
+    p_set, cases = load_fixture(path)
+    results = {'current': evaluate(decide_link, p_set, cases, repeat)}
+    report('current', results['current'])
+    for name, matcher in matchers.items():
+        results[name] = evaluate(matcher, p_set, cases, repeat)
+        report(name, results[name])
+        changes = diff(results['current'], results[name])
+        print(f'  {len(changes)} speakers linked differently from current')
+        for speaker, expected, before, rule, after, new_rule in changes:
+            print(f'    {speaker!r} (expected {expected}): {before} ({rule}) -> {after} ({new_rule})')
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixture', default=FIXTURE,
+                        help='YAML file with roster and labelled speakers')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='passes over the speakers for the timing')
+    parser.add_argument('--matcher', action='append', default=[],
+                        help="alternative matcher as 'module:function'")
+    args = parser.parse_args()
+    run_benchmark({path: load_matcher(path) for path in args.matcher},
+                  args.fixture, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
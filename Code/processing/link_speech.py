@@ -1,15 +1,20 @@
 """Combining the dataset of speeches with the data on members of parliament
 through the name of the speaker"""
 
+import hashlib
+import logging
+import multiprocessing
 from collections import namedtuple
 from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Iterable
 
 from jaro import jaro_winkler_metric as jw
 import sqlalchemy as sql
 from sqlalchemy.orm import Session
 
-from models import Speech, Personal, SpeechLink
+from models import (Speech, Speaker, Personal, Election, ParliamentSession, SpeechLink,
+                    LinkDecision)
 from helpers import Task, sql_get, logged
 
 
@@ -18,11 +23,16 @@ from helpers import Task, sql_get, logged
 # STEP 1: close to perfect matches (max Jaro-Winkler > 0.97)
 # STEP 2: last name or first and last name matches (*single* close to perfect match)
 # ------------------------  restriction of group -------------------------------
-# -> This is currently not part of the matching procedure
+# -> Only part of the matching procedure if LINK_BY_PARLIAMENT is set
 # STEP 3: unique close to perfect match of last name or first and last name
 # among the set of parliamentarians for which we have an election record for the
 # corresponding parliament
 
+# Decisions are stored with the rule that fired (see `decide_link`) and a
+# fingerprint of the roster; bump RULES_VERSION whenever the rules change so
+# that stored decisions are not reused
+RULES_VERSION = 1
+
 # Named tuples => query results  -----------------------------------------------
 
 Parl = namedtuple('Parl', [
@@ -56,6 +66,19 @@ def mean_jw(first: str, last: str, p: Parl):
     p_first = p.first_name.split(' ')[0]
     return (jw(first, p_first) + jw(last, p.last_name)) / 2
 
+
+def new_link(identifier: int, name: str) -> SpeechLink:
+    """Link of the speaker `name` to the parliamentarian `identifier`"""
+    return SpeechLink(identifier=identifier, name=name, speaker_id=Speaker.key(name))
+
+
+def roster_fingerprint(p_set: list[Parl]) -> str:
+    """Hash of the parliamentarians speakers are matched against"""
+    h = hashlib.blake2b(f'rules {RULES_VERSION}'.encode(), digest_size=16)
+    for p in sorted(p_set, key=lambda p: (p.identifier, p.name)):
+        h.update(f'\n{p.identifier}|{p.first_name}|{p.last_name}'.encode())
+    return h.hexdigest()
+
 # Queries ----------------------------------------------------------------------
 
 
@@ -66,7 +89,7 @@ def get_speech_personal(session: Session) -> tuple[list[Parl], list[Speech]]:
                         Personal.last_name, Personal.identifier)
     parls = sql_get(p_stmt, session)
     parliamentarians: list[Parl] = [Parl(join_names(p), *p) for p in parls]
-    s_stmt = sql.select(Speech.speaker_name)
+    s_stmt = sql.select(Speaker.name)
     speakers: set[str] = set(r[0] for r in sql_get(s_stmt, session))
     return (parliamentarians, speakers)
 
@@ -74,9 +97,10 @@ def get_speech_personal(session: Session) -> tuple[list[Parl], list[Speech]]:
 # Matching functions -----------------------------------------------------------
 
 
-def match_name(name: str, p_set: list[Parl], how: str):
+def match_name(name: str, p_set: list[Parl], how: str) -> tuple[SpeechLink | None, str]:
     """Create link instances with best matches of either first and last name
-    (ho='first_last) or last name only (how='last')"""
+    (ho='first_last) or last name only (how='last'); also returns the rule
+    that fired"""
     if how == 'first_last':
         # it is assumed that name in this case is only first and last name
         first, last = name.split(' ')
@@ -90,86 +114,182 @@ def match_name(name: str, p_set: list[Parl], how: str):
     close_matches = [c for c in candidates if c.score >= 0.97]
     perfect_matches = [c for c in close_matches if c.score == 1]
     if single(perfect_matches):
-        instance = SpeechLink(
-            identifier=perfect_matches[0].identifier, name=perfect_matches[0].speaker)
+        instance = new_link(perfect_matches[0].identifier, perfect_matches[0].speaker)
+        rule = f'{how}_perfect'
     elif single(close_matches):
-        instance = SpeechLink(
-            identifier=close_matches[0].identifier, name=close_matches[0].speaker)
+        instance = new_link(close_matches[0].identifier, close_matches[0].speaker)
+        rule = f'{how}_close'
     else:
         instance = None
-    return instance
+        rule = f'{how}_ambiguous' if close_matches else f'{how}_none'
+    return instance, rule
 
 
-def create_link(speaker: str, p_set: list[Parl]) -> SpeechLink:
+def decide_link(speaker: str, p_set: list[Parl]) -> tuple[SpeechLink | None, str]:
     """Rules for link creation: single best match if maximal score is above the
     threshold, last name if length of speaker name is 1, first and last name if
-    it is two"""
+    it is two. Returns the link (if any) and the rule that fired"""
     best_match: Match = find_highest_match(speaker, p_set)
     speaker_length = len(speaker.split(' '))
     if best_match.score >= 0.97:
-        instance = SpeechLink(identifier=best_match.identifier,
-                              name=best_match.name)
+        instance = new_link(best_match.identifier, best_match.name)
+        rule = 'best'
     elif speaker_length == 1:
         # only last_name; if list of MoP is not comprehensive, we migth use non-unique values
-        instance = match_name(speaker, p_set, 'last')
+        instance, rule = match_name(speaker, p_set, 'last')
     elif speaker_length == 2:
         # middle name is missing
-        instance = match_name(speaker, p_set, 'first_last')
+        instance, rule = match_name(speaker, p_set, 'first_last')
     else:
-        instance = None
-    return instance
+        instance, rule = None, 'none'
+    return instance, rule
+
+
+def create_link(speaker: str, p_set: list[Parl]) -> SpeechLink:
+    """Create the link of `speaker` according to `decide_link`"""
+    return decide_link(speaker, p_set)[0]
 
 
 # ------------------------------------------------------------------------------
 
-@logged
-def speech_link_worker(items: tuple[set[str], list[Parl]], session: Session) -> bool:
-    """Try to create a link to a parliamentarian for each speaker"""
-    parliamentarians, speakers = items
-    for s in speakers:
-        instance = create_link(s, parliamentarians)
-        if instance:
-            session.add(instance)
-            session.commit()
+# Decisions of the global mode (all speakers against all parliamentarians) are
+# stored under this parliament number
+ALL_PARLIAMENTS = 0
+
+# number of speakers scored per job
+CHUNK_SIZE = 500
+
+Decision = namedtuple('Decision', ['speaker', 'identifier', 'link_name', 'rule'])
 
 
-SpeechLinkTask = Task(get_speech_personal, speech_link_worker, SpeechLink)
+def score(speakers: list[str], p_set: list[Parl]) -> list[Decision]:
+    """Decide the links of `speakers` (run in a separate process)"""
+    decisions = []
+    for s in speakers:
+        instance, rule = decide_link(s, p_set)
+        decisions.append(Decision(s, instance.identifier if instance else None,
+                                  instance.name if instance else None, rule))
+    return decisions
+
+
+def link_parliament(parliament: int) -> int | None:
+    """Parliament stored with a link (None: valid in every parliament)"""
+    return None if parliament == ALL_PARLIAMENTS else parliament
+
+
+def get_decisions(session: Session) -> dict[tuple[str, int], LinkDecision]:
+    """Query the stored link decisions by speaker name and parliament"""
+    return {(d.name, d.parliament): d
+            for d in session.scalars(sql.select(LinkDecision))}
+
+
+def delete_decision(decision: LinkDecision, session: Session) -> None:
+    """Delete a stale decision and its link (if any)"""
+    if decision.identifier is not None:
+        parliament = link_parliament(decision.parliament)
+        session.execute(sql.delete(SpeechLink).where(
+            SpeechLink.speaker_id == Speaker.key(decision.link_name),
+            SpeechLink.identifier == decision.identifier,
+            SpeechLink.parliament.is_(None) if parliament is None
+            else SpeechLink.parliament == parliament))
+    session.delete(decision)
+
+
+def save_decisions(scored: list[Decision], parliament: int, roster: str,
+                   session: Session) -> None:
+    """Store the decisions and links of a scored chunk of speakers"""
+    for d in scored:
+        if d.identifier is not None:
+            link = new_link(d.identifier, d.link_name)
+            link.parliament = link_parliament(parliament)
+            session.add(link)
+        session.add(LinkDecision(name=d.speaker, parliament=parliament,
+                                 roster=roster, rule=d.rule,
+                                 identifier=d.identifier, link_name=d.link_name))
+
+
+def link_partitions(partitions: dict[int, tuple[list[Parl], set[str]]],
+                    session: Session) -> None:
+    """Match the speakers of each partition (parliament) against its roster;
+    speakers with a decision for the current roster are skipped. Chunks of
+    speakers are scored concurrently in separate processes"""
+    logger = logging.getLogger('link_partitions')
+    decisions = get_decisions(session)
+    # decisions of other partitions (e.g. of the other mode) are outdated
+    for key, d in decisions.items():
+        if key[1] not in partitions:
+            delete_decision(d, session)
+    jobs = {}
+    # spawned rather than forked, as the parent runs threads (e.g. logging)
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as pool:
+        for parliament, (p_set, speakers) in partitions.items():
+            if not p_set:
+                logger.warning('No parliamentarians in %s', parliament)
+                continue
+            roster = roster_fingerprint(p_set)
+            pending = []
+            for s in speakers:
+                stale = decisions.get((s, parliament))
+                if stale is None or stale.roster != roster:
+                    pending.append(s)
+                    if stale is not None:
+                        delete_decision(stale, session)
+            logger.info('Scoring %d of %d speakers in %s', len(pending),
+                        len(speakers), parliament)
+            for i in range(0, len(pending), CHUNK_SIZE):
+                chunk = pending[i:i + CHUNK_SIZE]
+                jobs[pool.submit(score, chunk, p_set)] = (parliament, roster)
+        session.flush()
+        for future in as_completed(jobs):
+            parliament, roster = jobs[future]
+            save_decisions(future.result(), parliament, roster, session)
+    session.commit()
 
 
-# -----------------------------------------------------------------------------
+@logged
+def speech_link_worker(items: tuple[list[Parl], set[str]], session: Session) -> None:
+    """Try to create a link to a parliamentarian for each speaker"""
+    link_partitions({ALL_PARLIAMENTS: items}, session)
 
 
-# def get_parliament(entry: Parl):
-#     return -1 if entry.parliament is None else entry.parliament
+SpeechLinkTask = Task(get_speech_personal, speech_link_worker, SpeechLink,
+                      config=[], inputs=[Speech, Personal])
 
 
-# def create_grouped_person(parliamentarians: list[Parl]) -> list[list[Parl]]:
-#     parliamentarians.sort(key=get_parliament)
-#     grouped_parliamentarians = [
-#         g for k, g in groupby(parliamentarians, get_parliament)]
-#     return grouped_parliamentarians
+# Grouped by parliament --------------------------------------------------------
 
 
-# def query_grouped_speeches(session: Session) -> list[list[Speech]]:
-#     stmt = sql.select(ParliamentSession)
-#     parliaments: list[ParliamentSession] = [s[0]
-#                                             for s in session.execute(stmt).all()]
-#     grouped_speeches: list[Speech] = []
-#     for p in parliaments:
-#         query = sql.select(Speech).where(sql.between(
-#             Speech.speech_date, p.start_date, p.end_date))
-#         result = [r[0] for r in session.execute(query).all()]
-#         grouped_speeches.append(result)
-#     return grouped_speeches
+@logged
+def get_grouped_speech_personal(session: Session) -> dict[int, tuple[list[Parl], set[str]]]:
+    """Query the parliamentarians elected to each parliament and the speakers
+    of the speeches given during that parliament"""
+    p_stmt = sql.select(Election.parliament, Personal.first_name,
+                        Personal.last_name, Personal.identifier).join(
+        Personal, onclause=Election.identifier == Personal.identifier).where(
+        Election.result == 'Elected').distinct()
+    date_condition = sql.between(Speech.speech_date, ParliamentSession.start_date,
+                                 ParliamentSession.end_date)
+    speaker_stmt = sql.select(ParliamentSession.parliament, Speech.speaker_id).select_from(
+        Speech).join(ParliamentSession, onclause=date_condition).distinct().subquery()
+    s_stmt = sql.select(speaker_stmt.c.parliament, Speaker.name).join(
+        Speaker, onclause=Speaker.speaker_id == speaker_stmt.c.speaker_id)
+    partitions = {}
+    for parliament, speaker in sql_get(s_stmt, session):
+        partitions.setdefault(parliament, ([], set()))[1].add(speaker)
+    for parliament, *p in sql_get(p_stmt, session):
+        if parliament in partitions:
+            partitions[parliament][0].append(Parl(join_names(p), *p))
+    return partitions
 
 
-# def get_grouped_speech_personal(parliamentarians, session: Session) -> tuple[list]:
-#     grouped_parliamentarians = create_grouped_person(parliamentarians)
-#     grouped_speeches = query_grouped_speeches(session)
-#     grouped_speakers = [set(s.speaker_name for s in g)
-#                         for g in grouped_speeches]
-#     return (grouped_parliamentarians, grouped_speakers)
+@logged
+def grouped_speech_link_worker(items: dict[int, tuple[list[Parl], set[str]]],
+                               session: Session) -> None:
+    """Link the speakers of each parliament to the parliamentarians elected to
+    it (STEP 3)"""
+    link_partitions(items, session)
 
 
-# GroupedSpeechTask = Task(get_grouped_speech_personal,
-#                          speech_link_worker, SpeechLink)
+GroupedSpeechLinkTask = Task(get_grouped_speech_personal,
+                             grouped_speech_link_worker, SpeechLink, config=[],
+                             inputs=[Speech, Personal, Election, ParliamentSession])
@@ -0,0 +1,100 @@
+"""Regenerate the cleaned speech texts from the stored tokens (e.g. after
+changing BANNED_WORDS or WORD_TYPES) without downloading and parsing the
+speeches again"""
+
+import zlib
+
+import numpy as np
+import sqlalchemy as sql
+from sqlalchemy.orm import Session
+
+from models import Speech, SpeechTokens, Lemma
+from helpers import Task, sql_get, logged
+from shards import schemas
+from nlp import POS_IDS
+from config import config
+
+
+BATCH_SIZE = 10000
+
+
+def decode_tokens(blob: bytes) -> tuple[np.ndarray, np.ndarray]:
+    """Lemma ids and tags of a token array (see `nlp.encode_tokens`)"""
+    data = zlib.decompress(blob)
+    n = len(data) // 9
+    ids = np.frombuffer(data, dtype='<i8', count=n)
+    tags = np.frombuffer(data, dtype=np.uint8, offset=8 * n)
+    return ids, tags
+
+
+def create_masks(lemmas: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Masks of allowed dictionary entries and of allowed tags (allowed word
+    types without the stopword flag)"""
+    banned = list(set(config['SPEECH_CRITERIA']['BANNED_WORDS']))
+    keep_lemma = ~np.isin(lemmas, banned)
+    keep_tag = np.zeros(256, dtype=bool)
+    for pos in config['SPEECH_CRITERIA']['WORD_TYPES']:
+        keep_tag[POS_IDS[pos]] = True
+    return keep_lemma, keep_tag
+
+
+@logged
+def get_dictionary(session: Session) -> tuple[np.ndarray, np.ndarray]:
+    """Obtain the lemma ids (sorted) and the corresponding lemmas"""
+    stmt = sql.select(Lemma.lemma_id, Lemma.lemma).order_by(Lemma.lemma_id)
+    rows = sql_get(stmt, session)
+    ids = np.array([r[0] for r in rows], dtype=np.int64)
+    lemmas = np.array([r[1] for r in rows], dtype=object)
+    return ids, lemmas
+
+
+def filter_batch(batch: list[tuple[int, bytes]], dictionary: tuple[np.ndarray, np.ndarray],
+                 masks: tuple[np.ndarray, np.ndarray]) -> list[dict]:
+    """Apply the filters to all tokens of `batch` at once"""
+    ids, lemmas = dictionary
+    keep_lemma, keep_tag = masks
+    decoded = [decode_tokens(tokens) for _, tokens in batch]
+    token_ids = np.concatenate([d[0] for d in decoded])
+    tags = np.concatenate([d[1] for d in decoded])
+    idx = np.searchsorted(ids, token_ids).clip(max=len(ids) - 1)
+    # lemmas missing in the dictionary are dropped
+    mask = (ids[idx] == token_ids) & keep_lemma[idx] & keep_tag[tags]
+    words = lemmas[idx]
+    offsets = np.cumsum([len(d[0]) for d in decoded])[:-1]
+    rows = []
+    for (speech_id, _), w, m in zip(batch, np.split(words, offsets),
+                                    np.split(mask, offsets)):
+        rows.append({'speech_id': speech_id,
+                     'speech_text': ''.join(f' {lemma}' for lemma in w[m])})
+    return rows
+
+
+@logged
+def refilter_speeches(dictionary: tuple[np.ndarray, np.ndarray], session: Session) -> None:
+    """Overwrite `Speech.speech_text` with the tokens passing the current
+    filters (see config)"""
+    if not len(dictionary[0]):
+        return
+    masks = create_masks(dictionary[1])
+    # the views of sharded speeches cannot be updated, so each shard is
+    # updated on its own
+    for schema in schemas():
+        options = {'schema_translate_map': {None: schema}}
+        last = None
+        while True:
+            stmt = sql.select(SpeechTokens.speech_id, SpeechTokens.tokens).order_by(
+                SpeechTokens.speech_id).limit(BATCH_SIZE).execution_options(**options)
+            if last is not None:
+                stmt = stmt.where(SpeechTokens.speech_id > last)
+            batch = sql_get(stmt, session)
+            if not batch:
+                break
+            session.execute(sql.update(Speech).execution_options(**options),
+                            filter_batch(batch, dictionary, masks))
+            session.commit()
+            last = batch[-1][0]
+
+
+RefilterTask = Task(get_dictionary, refilter_speeches, Speech,
+                    config=['SPEECH_CRITERIA.BANNED_WORDS', 'SPEECH_CRITERIA.WORD_TYPES'],
+                    inputs=[SpeechTokens, Lemma])
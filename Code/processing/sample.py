@@ -30,10 +30,14 @@ def create_sample(items: Sequence, session: Session):
     size = round(len(items) * config['SPEECH_CRITERIA']['TRAIN_SIZE'])
     random.seed(1)
     train_set = random.sample(items, size)
+    # sample of an earlier run
+    session.execute(sql.delete(Sample))
     for el in items:
         instance = Sample(speech_id=el, in_training=el in train_set)
         session.add(instance)
     session.commit()
 
 
-SampleTask = Task(get_speeches, create_sample, Sample)
+SampleTask = Task(get_speeches, create_sample, Sample,
+                  config=['SPEECH_CRITERIA.LENGTH', 'SPEECH_CRITERIA.TRAIN_SIZE'],
+                  inputs=[Speech])
@@ -0,0 +1,158 @@
+# ~/Code/shards.py
+
+"""Sharded storage of the speeches (see SHARDING in the config): the speeches,
+their tokens, lemmas and speakers are stored in one database per YEARS_PER_SHARD years,
+each written by its own process. Connections to the main database attach all
+shards and combine their tables in temporary views of the same names, so that
+queries of the speeches work unchanged"""
+
+import copy
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import sqlalchemy as sql
+import sqlalchemy.orm as orm
+
+from models import Speech, SpeechTokens, Lemma, Speaker, rebuild_topic_aggregates
+from helpers import Base, work_parallel, setup_logging, logged
+from config import config
+
+
+# tables stored in the shards instead of the main database
+TABLES = [Speech.__table__, SpeechTokens.__table__, Lemma.__table__, Speaker.__table__]
+
+# default limit of SQLite on attached databases
+MAX_SHARDS = 10
+
+
+def enabled() -> bool:
+    """Check if the speeches are sharded"""
+    return config['SHARDING']['ENABLED']
+
+
+def shard_years() -> list[int]:
+    """First year of each shard (within TIME_RANGE)"""
+    first, last = int(config['TIME_RANGE']['T0']), int(config['TIME_RANGE']['T1'])
+    years = list(range(first, last + 1, config['SHARDING']['YEARS_PER_SHARD']))
+    if len(years) > MAX_SHARDS:
+        raise ValueError(f'{len(years)} shards, at most {MAX_SHARDS} can be attached')
+    return years
+
+
+def shard_of(day: str | None) -> int:
+    """First year of the shard of the ISO date `day` (days outside of
+    TIME_RANGE go to the first or last shard)"""
+    years = shard_years()
+    if day is None:
+        return years[0]
+    return max((y for y in years if y <= int(day[:4])), default=years[0])
+
+
+def shard_path(year: int) -> str:
+    """File of the shard starting in `year`"""
+    return config['FILES']['SPEECH_SHARDS'].format(year)
+
+
+def schemas() -> list[str | None]:
+    """Names of the attached shards (None: the main database if not sharded),
+    e.g. for `schema_translate_map`"""
+    if not enabled():
+        return [None]
+    return [f'shard{i}' for i in range(len(shard_years()))]
+
+
+def create_shard(year: int) -> sql.Engine:
+    """Create the tables of the shard starting in `year` (if missing)"""
+    engine = sql.create_engine(f'sqlite+pysqlite:///{shard_path(year)}')
+    Base.metadata.create_all(engine, tables=TABLES)
+    return engine
+
+
+def create_shards() -> None:
+    """Create all shards, which have to exist to be attached"""
+    for year in shard_years():
+        create_shard(year).dispose()
+
+
+def attach_shards(dbapi_connection, connection_record) -> None:
+    """Attach all shards to a new connection of the main database and create
+    the views of the sharded tables"""
+    cursor = dbapi_connection.cursor()
+    names = schemas()
+    for name, year in zip(names, shard_years()):
+        cursor.execute(f'ATTACH DATABASE ? AS {name}', (shard_path(year),))
+    for table in TABLES:
+        # a lemma or speaker is stored in every shard which uses it
+        union = ' UNION ' if table in (Lemma.__table__, Speaker.__table__) else ' UNION ALL '
+        select = union.join(f'SELECT * FROM {name}.{table.name}' for name in names)
+        cursor.execute(f'CREATE TEMP VIEW IF NOT EXISTS {table.name} AS {select}')
+    cursor.close()
+
+
+def refresh_aggregates(session: orm.Session) -> None:
+    """Recompute the topic aggregates, as their triggers only see the (empty)
+    speech table of the main database if the speeches are sharded"""
+    if enabled():
+        rebuild_topic_aggregates(session.connection())
+        session.commit()
+
+
+# Writers ---------------------------------------------------------------------
+
+
+def init_writer(settings: dict) -> None:
+    """Set up a writer process with the configuration of the parent"""
+    config.clear()
+    config.update(settings)
+    setup_logging(config['FILES']['LOG'] + f'writer_{os.getpid()}.log')
+
+
+def write_shard(year: int, links: list[str]) -> list[str]:
+    """Download the speeches of `links` into the shard starting in `year` (in
+    a writer process) and return the links that failed twice"""
+    from download.get_speech import SpeechTask
+    from download import client
+    Session = orm.scoped_session(orm.sessionmaker(bind=create_shard(year)))
+    failed = work_parallel(SpeechTask.run, Session, links)
+    if failed:
+        failed = work_parallel(SpeechTask.run, Session, failed)
+    SpeechTask.report()
+    client.log_metrics()
+    return failed
+
+
+@logged
+def download_shards(links: list[str]) -> list[str]:
+    """Download the speeches with one writer process per shard (at most
+    SHARDING.WRITERS at once) and return the links that failed"""
+    from download.get_speech import link_day
+    groups: dict[int, list[str]] = {}
+    for link in links:
+        groups.setdefault(shard_of(link_day(link)), []).append(link)
+    if not groups:
+        return []
+    writers = min(config['SHARDING']['WRITERS'] or os.cpu_count(), len(groups))
+    settings = copy.deepcopy(config)
+    # the writers share the limit on concurrent requests
+    settings['MAX_CONCUR_REQ'] = max(1, config['MAX_CONCUR_REQ'] // writers)
+    settings['CONCURRENCY']['INITIAL'] = min(settings['CONCURRENCY']['INITIAL'],
+                                             settings['MAX_CONCUR_REQ'])
+    failed = []
+    # spawned rather than forked, as the parent runs threads (e.g. logging);
+    # a new process per shard starts with empty module state (e.g. the ids of
+    # the stored speeches in `get_speech`)
+    with ProcessPoolExecutor(max_workers=writers, initializer=init_writer,
+                             initargs=(settings,), max_tasks_per_child=1,
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(write_shard, year, group): year
+                   for year, group in groups.items()}
+        for future in as_completed(futures):
+            year = futures[future]
+            if future.exception() is not None:
+                logging.error('Writer of shard %s failed: %r', year, future.exception())
+                failed.extend(groups[year])
+            else:
+                failed.extend(future.result())
+    return failed
@@ -0,0 +1,129 @@
+# ~/Code/stages.py
+
+"""Skipping of unchanged Tasks: a Task which declares the configuration keys
+and input tables it reads (`Task.config`, `Task.inputs`) is only run again if
+one of those changed or its output tables were changed by something else since
+its last run. Otherwise its stored output (the tables, and what it printed) is
+served instead"""
+
+import hashlib
+import io
+import json
+import logging
+import sys
+from collections.abc import Callable
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import sqlalchemy as sql
+import sqlalchemy.orm as orm
+
+from models import StageFingerprint, TableVersion
+from helpers import Task
+from config import config
+
+
+class Tee(io.StringIO):
+    """Keep a copy of what is written to `stream`"""
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+
+    def write(self, text: str) -> int:
+        self.stream.write(text)
+        return super().write(text)
+
+
+def stage_name(task: Task) -> str:
+    """Name of the stored fingerprint of `task`"""
+    return f'{task.run.__module__}.{task.run.__name__}'
+
+
+def tables(models) -> list:
+    """Models of `Task.models` (a model, a list or None)"""
+    if models is None:
+        return []
+    return list(models) if isinstance(models, (list, tuple)) else [models]
+
+
+def config_value(key: str):
+    """Value of a dotted key of the config (None if missing)"""
+    value = config
+    for part in key.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def table_state(model, session: orm.Session) -> list:
+    """Version, number of rows and largest primary key of the table of `model`"""
+    table = model.__table__
+    version = session.get(TableVersion, table.name)
+    keys = list(table.primary_key.columns)
+    # a view (see `shards`) has no rowid, the primary key is used instead
+    largest = sql.func.max(keys[0]) if len(keys) == 1 else sql.null()
+    count, largest = session.execute(
+        sql.select(sql.func.count(), largest).select_from(table)).one()
+    return [version.version if version else 0, count, largest]
+
+
+def digest(value) -> str:
+    """Hash of a JSON serializable `value`"""
+    text = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def fingerprint(task: Task, session: orm.Session, args: tuple) -> str:
+    """Fingerprint of the configuration, inputs and arguments of `task`"""
+    return digest({'config': {key: config_value(key) for key in task.config},
+                   'inputs': {model.__table__.name: table_state(model, session)
+                              for model in task.inputs},
+                   'args': args})
+
+
+def outputs(task: Task, session: orm.Session) -> str:
+    """Fingerprint of the output tables of `task`"""
+    return digest({model.__table__.name: table_state(model, session)
+                   for model in tables(task.models)})
+
+
+def is_current(task: Task, session: orm.Session, args: tuple = ()) -> bool:
+    """Check if `task` ran with the same configuration and inputs and its
+    outputs are unchanged (printing its stored output if so)"""
+    if task.inputs is None or not config['STAGES']['SKIP_UNCHANGED']:
+        return False
+    stored = session.get(StageFingerprint, stage_name(task))
+    if stored is None or stored.fingerprint != fingerprint(task, session, args) \
+            or stored.outputs != outputs(task, session):
+        return False
+    logging.getLogger('stages').info('Skipping %s, unchanged since %s',
+                                     stored.stage, stored.updated)
+    print(stored.output, end='')
+    return True
+
+
+def run(task: Task, session: orm.Session, execute: Callable[[], None],
+        args: tuple = ()) -> None:
+    """Call `execute` (which runs `task` with `args`) unless `task` is current
+    and store its fingerprint afterwards"""
+    if is_current(task, session, args):
+        return
+    if task.inputs is None:
+        execute()
+        return
+    before = fingerprint(task, session, args)
+    with redirect_stdout(Tee(sys.stdout)) as printed:
+        execute()
+    for model in tables(task.models):
+        version = session.get(TableVersion, model.__table__.name)
+        if version is None:
+            version = TableVersion(name=model.__table__.name, version=0)
+            session.add(version)
+        version.version += 1
+    session.merge(StageFingerprint(stage=stage_name(task), fingerprint=before,
+                                   outputs=outputs(task, session),
+                                   output=printed.getvalue(),
+                                   updated=datetime.now()))
+    session.commit()